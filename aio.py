@@ -0,0 +1,200 @@
+"""
+This module contains the asyncio variant of the lookup pipeline. Dictionary
+requests run concurrently on an event loop and storing their answers is
+offloaded to a thread pool.
+
+The loop lives in its own thread, blocking code talks to it through
+``Pipeline.run`` and ``Pipeline.submit``. aiohttp is used for HTTP when it
+is installed, otherwise the blocking ``yadict.session`` runs on a pool of
+``concurrency`` threads of its own.
+
+``Pipeline.run`` blocks the calling thread, so single lookups made by the
+handlers are in flight at most one per handler thread. What the pipeline
+improves over ``yadict.fetch_many`` is batches: up to ``concurrency``
+terms of all batches are fetched at once instead of ``batch_concurrency``.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import config
+import offline
+import yadict
+
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+class Pipeline(object):
+
+    def __init__(self, db_threads, concurrency):
+        self.db_threads = db_threads
+        self.concurrency = concurrency
+        self.shared = 0
+        self.loop = None
+        self.executor = None
+        self.http_executor = None
+        self._thread = None
+        self._limit = None
+        self._http = None
+        self._flights = {}
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self.running:
+            return
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(
+            self.db_threads, thread_name_prefix='aio_db')
+        if aiohttp is None:
+            # blocking requests mustn't hold up storing the answers
+            self.http_executor = ThreadPoolExecutor(
+                self.concurrency, thread_name_prefix='aio_http')
+        ready = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(ready,), name='aio_pipeline', daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.executor.shutdown(wait=True)
+        if self.http_executor is not None:
+            self.http_executor.shutdown(wait=True)
+            self.http_executor = None
+        self._thread = None
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(ready.set)
+        self.loop.run_forever()
+        self.loop.run_until_complete(self._close())
+        self.loop.close()
+
+    async def _close(self):
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+
+    def submit(self, coro):
+        """
+        Schedules ``coro`` on the loop from any other thread and returns
+        a ``concurrent.futures.Future`` of its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        return self.submit(coro).result()
+
+    async def call(self, func, *args, **kwargs):
+        return await self.loop.run_in_executor(
+            self.executor, partial(func, *args, **kwargs))
+
+    async def fetch(self, content):
+        raw = offline.lookup(content)
+        if raw is not None:
+            return raw
+        if aiohttp is None:
+            response = await self.loop.run_in_executor(
+                self.http_executor, yadict.dicservice_request, content)
+            return response.text
+        yadict.circuit.allow()
+        start = time.monotonic()
+        failed = True
+        try:
+            status, text = await self._get(yadict.dicservice_url(content))
+            failed = status >= 500
+            return text
+        finally:
+            yadict.circuit.record(time.monotonic() - start, failed=failed)
+
+    async def _get(self, url):
+        if self._http is None:
+            self._http = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=config.Config.HTTP_CONNECT_TIMEOUT,
+                    sock_read=config.Config.HTTP_READ_TIMEOUT),
+                connector=aiohttp.TCPConnector(limit=self.concurrency))
+        # retries and their budget are those of the blocking session
+        backoffs = yadict.session.backoffs()
+        while True:
+            start = time.monotonic()
+            try:
+                async with self._http.get(url) as response:
+                    text = await response.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                yadict.session.record(start, failed=True)
+                delay = next(backoffs, None)
+                if delay is None:
+                    raise
+                logging.warning('dictionary request failed: %s', err)
+            else:
+                failed = response.status >= 500
+                yadict.session.record(start, failed=failed)
+                delay = next(backoffs, None) if failed else None
+                if delay is None:
+                    return response.status, text
+                logging.warning(
+                    'dictionary request failed: %s', response.status)
+            await asyncio.sleep(delay)
+
+    async def _fetch_limited(self, content):
+        if self._limit is None:
+            self._limit = asyncio.Semaphore(self.concurrency)
+        async with self._limit:
+            return await self.fetch(content)
+
+    def _share(self, key, start):
+        # concurrent callers with the same key await a single task
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self.loop.create_task(start())
+            self._flights[key] = flight
+            flight.add_done_callback(lambda _: self._flights.pop(key, None))
+        else:
+            self.shared += 1
+        return asyncio.shield(flight)
+
+    def _fetch_shared(self, content):
+        return self._share(
+            ('fetch', content), partial(self._fetch_limited, content))
+
+    async def fetch_many(self, contents):
+        results = await asyncio.gather(
+            *[self._fetch_shared(content) for content in contents],
+            return_exceptions=True)
+        for content, result in zip(contents, results):
+            if isinstance(result, Exception):
+                logging.error('lookup of %s failed: %s', content, result)
+        return [None if isinstance(result, Exception) else result
+                for result in results]
+
+    async def load_content_from_api(self, content):
+        return await self._share(
+            content, partial(self._load_content_from_api, content))
+
+    async def _load_content_from_api(self, content):
+        raw = await self._fetch_shared(content)
+        return await self.call(yadict.store_content, content, raw)
+
+
+pipeline = Pipeline(
+    db_threads=config.Config.AIO_DB_THREADS,
+    concurrency=config.Config.AIO_CONCURRENCY
+)
@@ -0,0 +1,217 @@
+"""
+End-to-end throughput and latency of the update handlers. Synthetic
+updates drive translate_command and the handle_text -> callback_handler
+dialog against a recording fake bot and the stub lookup endpoint, for
+cold (every word fetched), warm (answers cached), miss (unknown words)
+and mixed workloads, on in-memory and on-disk SQLite.
+
+    python -m benchmarks.handlers [--updates N] [--latency S] [--output FILE]
+
+Results are printed and written as JSON to compare runs.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+
+from datetime import datetime
+
+import telegram
+
+import cache
+import config
+import models
+import yadict
+import yappi
+
+from tests.stub import StubDictionaryServer
+
+MIXES = {
+    'cold': {'cold': 1.0},
+    'warm': {'warm': 1.0},
+    'miss': {'miss': 1.0},
+    'mixed': {'cold': 0.2, 'warm': 0.7, 'miss': 0.1},
+}
+WARM_WORDS = 200
+
+
+class Sent(object):
+
+    def __init__(self, message_id, chat_id, text, reply_markup):
+        self.message_id = message_id
+        self.chat_id = chat_id
+        self.text = text
+        self.reply_markup = reply_markup
+
+
+class FakeBot(object):
+    """
+    Records every outgoing message instead of calling the Bot API.
+    """
+
+    def __init__(self):
+        self.sent = []
+        self._ids = itertools.count(1)
+
+    def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        message = Sent(next(self._ids), chat_id, text, reply_markup)
+        self.sent.append(message)
+        return message
+
+    def edit_message_text(self, text, chat_id, message_id,
+                          reply_markup=None, **kwargs):
+        message = Sent(message_id, chat_id, text, reply_markup)
+        self.sent.append(message)
+        return message
+
+
+class Updates(object):
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def message(self, user_id, text):
+        user = telegram.User(user_id, 'user{}'.format(user_id))
+        chat = telegram.Chat(user_id, 'private')
+        message = telegram.Message(
+            next(self._ids), user, datetime.now(), chat, text=text)
+        return telegram.Update(next(self._ids), message=message)
+
+    def callback(self, user_id, message, data):
+        user = telegram.User(user_id, 'user{}'.format(user_id))
+        query = telegram.CallbackQuery(
+            str(next(self._ids)), user, str(user_id),
+            message=message, data=data)
+        return telegram.Update(next(self._ids), callback_query=query)
+
+
+def use_database(path):
+    models.db.close()
+    # pragmas given to the database at construction are kept
+    models.db.init(path)
+    models.create_tables()
+    for lru in (cache.answers, cache.misses, cache.speller_misses,
+                cache.users, cache.chats):
+        lru.clear()
+
+
+def words(kind, count):
+    return ['{}{}'.format(kind, number) for number in range(count)]
+
+
+def workload(mix, count, seed=0):
+    generator = random.Random(seed)
+    kinds, weights = zip(*sorted(MIXES[mix].items()))
+    cold = iter(words('cold', count))
+    miss = iter(words('miss', count))
+    warm = words('warm', WARM_WORDS)
+    for _ in range(count):
+        kind = generator.choices(kinds, weights)[0]
+        if kind == 'cold':
+            yield next(cold)
+        elif kind == 'miss':
+            yield next(miss)
+        else:
+            yield generator.choice(warm)
+
+
+def command(bot, updates, user_id, word):
+    update = updates.message(user_id, '/tr {}'.format(word))
+    yappi.translate_command(bot, update, args=[word])
+
+
+def dialog(bot, updates, user_id, word):
+    user_data = {}
+    update = updates.message(user_id, word)
+    yappi.handle_text(bot, update, user_data=user_data)
+    offer = bot.sent[-1]
+    data = offer.reply_markup.inline_keyboard[0][0].callback_data
+    message = telegram.Message(
+        offer.message_id, update.message.from_user, datetime.now(),
+        update.message.chat)
+    yappi.callback_handler(
+        bot, updates.callback(user_id, message, data),
+        user_data=user_data, chat_data={})
+
+
+def percentile(latencies, q):
+    return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+def run(handler, mix, count):
+    bot = FakeBot()
+    updates = Updates()
+    # every user asks once, so warm words never hit "already requested"
+    users = itertools.count(1)
+    for word in words('warm', WARM_WORDS):
+        handler(bot, updates, next(users), word)
+
+    latencies = []
+    start = time.perf_counter()
+    for word in workload(mix, count):
+        began = time.perf_counter()
+        handler(bot, updates, next(users), word)
+        latencies.append(time.perf_counter() - began)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'updates': count,
+        'throughput': count / elapsed,
+        'mean': sum(latencies) / count,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'max': latencies[-1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--updates', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='stub dictionary latency, seconds')
+    parser.add_argument('--output', default='benchmark-handlers.json')
+    args = parser.parse_args()
+
+    results = []
+    tmpdir = tempfile.TemporaryDirectory()
+    databases = [('memory', ':memory:'),
+                 ('disk', os.path.join(tmpdir.name, 'bench.db'))]
+    with StubDictionaryServer(
+            latency=args.latency, missing=words('miss', args.updates)) as server:
+        yadict.ENDPOINT = server.endpoint
+        # misses must not reach the network speller
+        config.Config.SPELLING_FALLBACK = False
+        for (database, path), (name, handler), mix in itertools.product(
+                databases, [('command', command), ('dialog', dialog)],
+                sorted(MIXES)):
+            if os.path.exists(path):
+                os.remove(path)
+            use_database(path)
+            result = dict(run(handler, mix, args.updates),
+                          database=database, handler=name, mix=mix)
+            results.append(result)
+            print('{database:<7} {handler:<8} {mix:<6} '
+                  '{throughput:>8.0f} updates/s  p50 {p50_ms:>7.2f}ms  '
+                  'p99 {p99_ms:>7.2f}ms'.format(
+                      p50_ms=result['p50'] * 1000,
+                      p99_ms=result['p99'] * 1000, **result))
+    models.db.close()
+    tmpdir.cleanup()
+
+    with open(args.output, 'w') as output:
+        json.dump({
+            'python': platform.python_version(),
+            'stub_latency': args.latency,
+            'updates': args.updates,
+            'results': results,
+        }, output, indent=2)
+    print('results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
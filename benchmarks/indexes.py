@@ -0,0 +1,96 @@
+"""
+Lookup latency of the hot queries with and without the indexes added by
+migrations/003_add_lookup_indexes.py.
+
+    python -m benchmarks.indexes [rows]
+"""
+
+import os
+import random
+import sqlite3
+import string
+import sys
+import tempfile
+import time
+
+SCHEMA = [
+    'CREATE TABLE request (id INTEGER PRIMARY KEY, content VARCHAR(255), '
+    'raw VARCHAR(255), counter INTEGER)',
+    'CREATE TABLE firstrequest (id INTEGER PRIMARY KEY, request INTEGER, '
+    'chat INTEGER, user INTEGER, message INTEGER, reply_to INTEGER)',
+]
+INDEXES = [
+    'CREATE UNIQUE INDEX request_content ON request (content)',
+    'CREATE UNIQUE INDEX firstrequest_request_chat_user '
+    'ON firstrequest (request, chat, user)',
+]
+GET_REQUEST = 'SELECT id, raw, counter FROM request WHERE content = ?'
+GET_FIRST_REQUEST = ('SELECT id FROM firstrequest '
+                     'WHERE request = ? AND chat = ? AND user = ?')
+RAW = '{"head": {}, "def": [%s]}' % ', '.join(['{"text": "x"}'] * 20)
+
+
+def word(index):
+    return '{}{}'.format(
+        ''.join(random.choice(string.ascii_lowercase) for _ in range(6)), index)
+
+
+def populate(conn, rows):
+    conn.executemany(
+        'INSERT INTO request (content, raw, counter) VALUES (?, ?, 1)',
+        ((word(i), RAW) for i in range(rows)))
+    conn.executemany(
+        'INSERT INTO firstrequest (request, chat, user, message, reply_to) '
+        'VALUES (?, ?, ?, 0, 0)',
+        ((i + 1, i % 1000, i % 5000) for i in range(rows)))
+    conn.commit()
+
+
+def measure(conn, query, params, repeat):
+    start = time.perf_counter()
+    for args in params[:repeat]:
+        conn.execute(query, args).fetchall()
+    return (time.perf_counter() - start) / repeat
+
+
+def run(rows):
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    conn = sqlite3.connect(path)
+    for statement in SCHEMA:
+        conn.execute(statement)
+    populate(conn, rows)
+    contents = [row[0] for row in conn.execute(
+        'SELECT content FROM request ORDER BY RANDOM() LIMIT 1000')]
+    lookups = [(content,) for content in contents]
+    first_requests = [
+        tuple(row) for row in conn.execute(
+            'SELECT request, chat, user FROM firstrequest '
+            'ORDER BY RANDOM() LIMIT 1000')]
+
+    results = [
+        ('get_request', 'no index', measure(conn, GET_REQUEST, lookups, 20)),
+        ('get_first_request', 'no index',
+         measure(conn, GET_FIRST_REQUEST, first_requests, 20)),
+    ]
+    for statement in INDEXES:
+        conn.execute(statement)
+    results += [
+        ('get_request', 'indexed', measure(conn, GET_REQUEST, lookups, 1000)),
+        ('get_first_request', 'indexed',
+         measure(conn, GET_FIRST_REQUEST, first_requests, 1000)),
+    ]
+    conn.close()
+    os.remove(path)
+    return results
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    print('{} rows'.format(rows))
+    for query, mode, seconds in run(rows):
+        print('{:<18} {:<9} {:>10.1f} us/query'.format(
+            query, mode, seconds * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Parse+render throughput of yadict.format_dict_message against the
+previous renderer concatenating with str +=.
+
+    python -m benchmarks.render [iterations]
+"""
+
+import json
+import sys
+import timeit
+
+import yadict
+from templates import Translate
+
+ENTRY = {
+    'head': {},
+    'def': [
+        {
+            'text': 'time', 'pos': 'noun', 'ts': 'taɪm',
+            'tr': [
+                {
+                    'text': 'время', 'pos': 'noun', 'gen': 'ср',
+                    'syn': [{'text': 'период', 'pos': 'noun', 'gen': 'м'}],
+                    'mean': [{'text': 'period'}, {'text': 'hour'}],
+                    'ex': [{'text': 'short time',
+                            'tr': [{'text': 'короткое время'}]}]
+                },
+                {
+                    'text': 'раз', 'pos': 'noun', 'gen': 'м',
+                    'mean': [{'text': 'once'}],
+                    'ex': [{'text': 'first time',
+                            'tr': [{'text': 'первый раз'},
+                                   {'text': 'впервые'}]}]
+                },
+                {'text': 'срок', 'pos': 'noun', 'gen': 'м'},
+            ]
+        },
+        {
+            'text': 'time', 'pos': 'verb', 'ts': 'taɪm',
+            'tr': [
+                {'text': 'рассчитывать', 'pos': 'verb', 'asp': 'несов',
+                 'mean': [{'text': 'calculate'}]},
+                {'text': 'засекать', 'pos': 'verb', 'asp': 'несов'},
+            ]
+        },
+    ]
+}
+RAW = json.dumps(ENTRY, ensure_ascii=False, indent=2)
+
+
+def legacy_format_dict_message(data):
+    res = ''
+    delimeter = '\n'
+    nbsp = u'\xa0'
+    for _, topic in enumerate(data):
+        res += Translate.POS.format(topic['pos'])
+        if 'ts' in topic:
+            res += Translate.TRANSCRIPTION.format(topic['ts'], delimeter)
+        else:
+            res += delimeter
+        for tr in topic['tr']:
+            res += Translate.TRANSLATION.format(nbsps=4 * nbsp, text=tr['text'])
+            if 'mean' in tr:
+                mean = ''
+                for m in tr['mean']:
+                    mean += Translate.MEANING_UNIT.format(m=m['text'])
+                mean = Translate.MEANING.format(mean.rstrip('; '), delimeter)
+                res += mean
+            else:
+                res += delimeter
+            if 'ex' in tr:
+                tmp = Translate.EXAMPLE.format(
+                    nbsps=8 * nbsp,
+                    ex=tr['ex'][0]['text'],
+                    ex_tr='/ '.join([etr['text'] for etr in tr['ex'][0]['tr']]),
+                    delimeter=delimeter
+                )
+                res += tmp
+    return res
+
+
+def concat_parse_render():
+    return legacy_format_dict_message(json.loads(RAW)['def'])
+
+
+def join_parse_render():
+    return yadict.format_dict_message(json.loads(RAW)['def'])
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    assert concat_parse_render() == join_parse_render()
+
+    for name, func in [('concat', concat_parse_render),
+                       ('join', join_parse_render)]:
+        seconds = min(timeit.repeat(func, number=iterations, repeat=3))
+        print('{:<6} parse+render {:>9.0f} entries/s'.format(
+            name, iterations / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+This module contains a circuit breaker for calls to a degraded upstream.
+
+The breaker trips open when too many of the recent calls failed or were
+slower than ``slow_call``, fails fast while open and after
+``reset_timeout`` lets a few half-open probes through to decide whether
+to close again.
+"""
+
+import logging
+import threading
+import time
+
+from collections import deque
+
+import exceptions
+
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# exported as a single gauge, 0 closed, 1 half-open, 2 open
+STATES = (CLOSED, HALF_OPEN, OPEN)
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, failure_ratio, slow_call, window=50, min_calls=10,
+                 reset_timeout=30, half_open_calls=3, failed=None,
+                 on_transition=None, clock=time.monotonic):
+        self.failure_ratio = failure_ratio
+        self.slow_call = slow_call
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        # tells failed results of calls that returned from successes
+        self.failed = failed or (lambda result: False)
+        self.on_transition = on_transition
+        self.clock = clock
+        self.state = CLOSED
+        self.rejected = 0
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probes = 0
+        self._successes = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Raises ``exceptions.CircuitOpen`` unless a call may go through now.
+        Every allowed call must be followed by ``record``.
+        """
+        with self._lock:
+            if self.state == OPEN:
+                if self.clock() - self._opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    raise exceptions.CircuitOpen
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    self.rejected += 1
+                    raise exceptions.CircuitOpen
+                self._probes += 1
+
+    def record(self, latency, failed):
+        failed = failed or (self.slow_call and latency > self.slow_call)
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probes -= 1
+                if failed:
+                    self._transition(OPEN)
+                    return
+                self._successes += 1
+                if self._successes >= self.half_open_calls:
+                    self._transition(CLOSED)
+                return
+            if self.state == OPEN:
+                # a call allowed before the breaker tripped
+                return
+            self._outcomes.append(bool(failed))
+            failures = sum(self._outcomes)
+            if len(self._outcomes) >= self.min_calls and \
+                    failures >= self.failure_ratio * len(self._outcomes):
+                self._transition(OPEN)
+
+    def call(self, func, *args, **kwargs):
+        self.allow()
+        start = self.clock()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.record(self.clock() - start, failed=True)
+            raise
+        self.record(self.clock() - start, failed=self.failed(result))
+        return result
+
+    def _transition(self, state):
+        previous, self.state = self.state, state
+        self._outcomes.clear()
+        self._probes = 0
+        self._successes = 0
+        if state == OPEN:
+            self._opened_at = self.clock()
+        logging.warning('circuit breaker %s -> %s', previous, state)
+        if self.on_transition is not None:
+            self.on_transition(previous, state)
+
+    def reset(self):
+        with self._lock:
+            if self.state != CLOSED:
+                self._transition(CLOSED)
+
+    def stats(self):
+        with self._lock:
+            outcomes = len(self._outcomes)
+            return {
+                'state': STATES.index(self.state),
+                'failure_ratio': (sum(self._outcomes) / outcomes
+                                  if outcomes else 0.0),
+                'rejected': self.rejected,
+            }
@@ -0,0 +1,235 @@
+"""
+This module contains in-process caches used in front of the database.
+"""
+
+import hashlib
+import math
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+
+import config
+
+
+def default_sizeof(key, value):
+    return sys.getsizeof(key) + sys.getsizeof(value)
+
+
+class LRUCache(object):
+    """
+    Thread-safe LRU cache bounded by number of entries and by an
+    approximate size in bytes, with optional time-to-live for entries.
+    """
+
+    def __init__(self, max_entries, max_bytes=None, ttl=None,
+                 sizeof=default_sizeof, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        # a membership test isn't a lookup, hits and misses stay untouched
+        with self._lock:
+            try:
+                _, _, expires = self._data[key]
+            except KeyError:
+                return False
+            return expires is None or expires > self.clock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size, expires = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= self.clock():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl=None):
+        size = self.sizeof(key, value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        ttl = ttl or self.ttl
+        expires = self.clock() + ttl if ttl else None
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, size, expires)
+            self.size += size
+            while self._data and (
+                    len(self._data) > self.max_entries or
+                    (self.max_bytes is not None and self.size > self.max_bytes)):
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        _, size, _ = self._data.pop(key)
+        self.size -= size
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {
+            'entries': len(self._data),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hit_rate,
+        }
+
+
+class BloomFilter(object):
+    """
+    Set membership in a fixed bit array: no false negatives, false
+    positives at about ``error_rate`` while it holds up to ``capacity``
+    keys.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.count = 0
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, key):
+        # double hashing of a single 128 bit digest
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self._array[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+    def __len__(self):
+        return self.count
+
+
+class SeenIndex(object):
+    """
+    Bloom filter of the keys of a table, filled from ``load_keys`` by
+    ``load`` and kept current by ``add`` on every insert, so a negative
+    answer means the row doesn't exist without asking the database.
+    Until it is loaded every key might exist.
+    """
+
+    def __init__(self, load_keys, capacity, error_rate=0.01):
+        self.load_keys = load_keys
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._filter = None
+        # keys inserted before the filter was loaded
+        self._pending = []
+        self._lock = threading.Lock()
+        self._loading = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._filter is not None
+
+    def load(self):
+        with self._loading:
+            if self._filter is not None:
+                return
+            # the scan doesn't hold up add(), its keys are merged at the end
+            bloom = BloomFilter(self.capacity, self.error_rate)
+            for key in self.load_keys():
+                bloom.add(key)
+            with self._lock:
+                for key in self._pending:
+                    bloom.add(key)
+                self._pending = []
+                self._filter = bloom
+
+    def add(self, key):
+        with self._lock:
+            if self._filter is None:
+                self._pending.append(key)
+            else:
+                self._filter.add(key)
+
+    def might_contain(self, key):
+        bloom = self._filter
+        return bloom is None or key in bloom
+
+    def reset(self):
+        with self._lock:
+            self._filter = None
+            self._pending = []
+
+    def stats(self):
+        bloom = self._filter
+        return {
+            'keys': len(bloom) if bloom is not None else 0,
+            'capacity': self.capacity,
+        }
+
+
+# rendered answers keyed by normalized request content
+answers = LRUCache(
+    max_entries=config.Config.ANSWER_CACHE_SIZE,
+    max_bytes=config.Config.ANSWER_CACHE_BYTES,
+    ttl=config.Config.ANSWER_CACHE_TTL
+)
+
+# normalized contents the dictionary has nothing for
+misses = LRUCache(
+    max_entries=config.Config.NEGATIVE_CACHE_SIZE,
+    ttl=config.Config.NEGATIVE_CACHE_TTL
+)
+
+# missed words the speller service had no correction for, kept apart so
+# they don't count in the hit rate of the negative cache
+speller_misses = LRUCache(
+    max_entries=config.Config.NEGATIVE_CACHE_SIZE,
+    ttl=config.Config.NEGATIVE_CACHE_TTL
+)
+
+# primary keys of users and chats by their telegram ids
+users = LRUCache(max_entries=config.Config.IDENTITY_CACHE_SIZE)
+chats = LRUCache(max_entries=config.Config.IDENTITY_CACHE_SIZE)
+
+# first requests found in the database by (request, chat, user)
+first_requests = LRUCache(max_entries=config.Config.SEEN_CACHE_SIZE)
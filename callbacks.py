@@ -0,0 +1,147 @@
+"""
+This module contains stores for text waiting behind inline keyboard
+callbacks.
+"""
+
+import itertools
+import logging
+import threading
+import time
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+import config
+
+from models import write_queue, CallbackEntity
+
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+class CallbackStore(ABC):
+    """
+    Keeps callback data under integer indexes, with a background thread
+    sweeping out expired entries.
+    """
+
+    def __init__(self, max_entries, sweep_interval):
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
+        self._sweeper = None
+
+    @abstractmethod
+    def save(self, data):
+        """
+        Stores ``data`` and returns the index to put in the callback.
+        """
+
+    @abstractmethod
+    def pop(self, index):
+        """
+        Removes and returns the data under ``index``, None if it's gone.
+        """
+
+    @abstractmethod
+    def sweep(self):
+        """
+        Drops expired entries.
+        """
+
+    def start(self):
+        if self._sweeper is not None:
+            return
+        self._sweeper = threading.Thread(
+            target=self._sweep_forever, name='callback_sweeper', daemon=True)
+        self._sweeper.start()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as err:
+                logging.exception(str(err))
+
+
+class MemoryCallbackStore(CallbackStore):
+    """
+    Bounded in-memory store, the oldest entries are dropped on overflow
+    and expired ones are removed by a background sweeper.
+    """
+
+    def __init__(self, max_entries, ttl, sweep_interval, clock=time.monotonic):
+        super().__init__(max_entries, sweep_interval)
+        self.ttl = ttl
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # indexes from a previous run must not point to new entries
+        self._indexes = itertools.count(int(time.time() * 1000))
+
+    def __len__(self):
+        return len(self._data)
+
+    def save(self, data):
+        expires = self.clock() + self.ttl
+        with self._lock:
+            index = next(self._indexes)
+            self._data[index] = (data, expires)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+        return index
+
+    def pop(self, index):
+        with self._lock:
+            entry = self._data.pop(index, None)
+        if entry is None:
+            return
+        data, expires = entry
+        if expires <= self.clock():
+            return
+        return data
+
+    def sweep(self):
+        now = self.clock()
+        removed = 0
+        with self._lock:
+            # entries are kept in insertion order, so expiry is monotonic
+            while self._data:
+                index, (_, expires) = next(iter(self._data.items()))
+                if expires > now:
+                    break
+                del self._data[index]
+                removed += 1
+        return removed
+
+
+class DatabaseCallbackStore(CallbackStore):
+    """
+    Durable store backed by the CallbackEntity table.
+    """
+
+    def save(self, data):
+        return write_queue.submit(CallbackEntity.create, data=data).result()
+
+    def pop(self, index):
+        return write_queue.submit(CallbackEntity.get_callback, index).result()
+
+    def sweep(self):
+        return write_queue.submit(
+            CallbackEntity.compact, self.max_entries).result()
+
+
+def make_store():
+    if config.Config.CALLBACK_STORE == 'db':
+        return DatabaseCallbackStore(
+            max_entries=config.Config.CALLBACK_STORE_SIZE,
+            sweep_interval=config.Config.CALLBACK_SWEEP_INTERVAL
+        )
+    return MemoryCallbackStore(
+        max_entries=config.Config.CALLBACK_STORE_SIZE,
+        ttl=config.Config.CALLBACK_TTL,
+        sweep_interval=config.Config.CALLBACK_SWEEP_INTERVAL
+    )
+
+
+store = make_store()
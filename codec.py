@@ -0,0 +1,105 @@
+"""
+This module contains the compact storage format of raw dictionary answers.
+
+A stored value is a format version byte followed by the zlib stream of
+the minified JSON text:
+
+    1 - plain zlib
+    2 - zlib with the shared preset dictionary
+
+Values that are still plain text (stored before compression) are passed
+through as is.
+"""
+
+import json
+import os
+import re
+import zlib
+
+from collections import Counter
+
+import config
+
+PLAIN = 1
+SHARED_DICTIONARY = 2
+
+# zlib doesn't use more than the last 32K of a preset dictionary
+MAX_DICTIONARY_SIZE = 32 * 1024
+
+TOKEN = re.compile(r'"[a-z]+": (?:"[^"]*"|\[\{|\{)?')
+
+
+def minify(text):
+    # keeps the default separators, they are next to free after compression
+    # and leave compact answers byte-for-byte unchanged
+    try:
+        return json.dumps(json.loads(text), ensure_ascii=False)
+    except ValueError:
+        return text
+
+
+def encode(text, dictionary=None):
+    data = minify(text).encode('utf-8')
+    if dictionary:
+        compressor = zlib.compressobj(level=9, zdict=dictionary)
+        version = SHARED_DICTIONARY
+    else:
+        compressor = zlib.compressobj(level=9)
+        version = PLAIN
+    return bytes([version]) + compressor.compress(data) + compressor.flush()
+
+
+def decode(value, dictionary=None):
+    if value is None or isinstance(value, str):
+        return value
+    value = bytes(value)
+    version, payload = value[0], value[1:]
+    if version == PLAIN:
+        return zlib.decompress(payload).decode('utf-8')
+    if version == SHARED_DICTIONARY:
+        if not dictionary:
+            # trained after this process started, see 006_compress_raw.py
+            dictionary = reload_dictionary()
+        if not dictionary:
+            raise ValueError('shared dictionary is required to decode value')
+        decompressor = zlib.decompressobj(zdict=dictionary)
+        data = decompressor.decompress(payload) + decompressor.flush()
+        return data.decode('utf-8')
+    raise ValueError('unknown raw format version {}'.format(version))
+
+
+def train_dictionary(samples, size=MAX_DICTIONARY_SIZE):
+    """
+    Builds a preset dictionary out of the JSON fragments most common in
+    ``samples``. The most frequent ones go last, where zlib reaches them
+    with the shortest distances.
+    """
+    tokens = Counter()
+    for sample in samples:
+        tokens.update(TOKEN.findall(minify(sample)))
+    chosen = []
+    total = 0
+    for token, _ in tokens.most_common():
+        encoded = token.encode('utf-8')
+        if total + len(encoded) > size:
+            break
+        chosen.append(encoded)
+        total += len(encoded)
+    return b''.join(reversed(chosen))
+
+
+def load_dictionary(path):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, 'rb') as dictionary:
+        return dictionary.read()
+
+
+def reload_dictionary():
+    global dictionary
+    if dictionary is None:
+        dictionary = load_dictionary(config.Config.RAW_DICTIONARY)
+    return dictionary
+
+
+dictionary = load_dictionary(config.Config.RAW_DICTIONARY)
@@ -15,3 +15,72 @@ class Config(object):
     YKEY = settings['yandex_key']
     DB_NAME = settings['db_name']
     SR_BOT = settings['spaced_repetition_bot']
+    ANSWER_CACHE_SIZE = settings.get('answer_cache_size', 10000)
+    ANSWER_CACHE_BYTES = settings.get('answer_cache_bytes', 32 * 1024 * 1024)
+    ANSWER_CACHE_TTL = settings.get('answer_cache_ttl', 24 * 60 * 60)
+    HTTP_CONNECT_TIMEOUT = settings.get('http_connect_timeout', 3.05)
+    HTTP_READ_TIMEOUT = settings.get('http_read_timeout', 10)
+    HTTP_RETRIES = settings.get('http_retries', 2)
+    HTTP_BACKOFF = settings.get('http_backoff', 0.2)
+    HTTP_POOL_SIZE = settings.get('http_pool_size', 8)
+    HTTP_RETRY_RATIO = settings.get('http_retry_ratio', 0.2)
+    NEGATIVE_CACHE_SIZE = settings.get('negative_cache_size', 10000)
+    NEGATIVE_CACHE_TTL = settings.get('negative_cache_ttl', 24 * 60 * 60)
+    NEGATIVE_CACHE_PERSIST = settings.get('negative_cache_persist', False)
+    CALLBACK_STORE = settings.get('callback_store', 'memory')
+    CALLBACK_STORE_SIZE = settings.get('callback_store_size', 100000)
+    CALLBACK_TTL = settings.get('callback_ttl', 2 * 24 * 60 * 60)
+    CALLBACK_SWEEP_INTERVAL = settings.get('callback_sweep_interval', 60)
+    IDENTITY_CACHE_SIZE = settings.get('identity_cache_size', 10000)
+    SQLITE_PRAGMAS = settings.get('sqlite_pragmas', {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'busy_timeout': 5000,
+    })
+    WRITE_QUEUE = settings.get('write_queue', False)
+    WRITE_BATCH_SIZE = settings.get('write_batch_size', 100)
+    WRITE_BATCH_LATENCY = settings.get('write_batch_latency', 0.01)
+    COUNTER_FLUSH_INTERVAL = settings.get('counter_flush_interval', 5)
+    COUNTER_MAX_PENDING = settings.get('counter_max_pending', 1000)
+    # relative to the project, like settings.yaml
+    RAW_DICTIONARY = settings.get('raw_dictionary') and os.path.join(
+        __location__, settings['raw_dictionary'])
+    OFFLINE_INDEX = settings.get('offline_index')
+    WARMUP_SIZE = settings.get('warmup_size', 1000)
+    WORKERS = settings.get('workers', 0)
+    WORKER_QUEUE_SIZE = settings.get('worker_queue_size', 0)
+    ASYNC_LOOKUPS = settings.get('async_lookups', False)
+    AIO_DB_THREADS = settings.get('aio_db_threads', 4)
+    AIO_CONCURRENCY = settings.get('aio_concurrency', 100)
+    BATCH_MAX_TERMS = settings.get('batch_max_terms', 50)
+    BATCH_CONCURRENCY = settings.get('batch_concurrency', 8)
+    METRICS = settings.get('metrics', False)
+    METRICS_FILE = settings.get('metrics_file')
+    METRICS_PORT = settings.get('metrics_port')
+    METRICS_INTERVAL = settings.get('metrics_interval', 15)
+    ADMINS = settings.get('admins', [])
+    SPELLING_MAX_DISTANCE = settings.get('spelling_max_distance', 1)
+    SPELLING_WORDS = settings.get('spelling_words')
+    SPELLING_FALLBACK = settings.get('spelling_fallback', False)
+    SEEN_CAPACITY = settings.get('seen_capacity', 1000000)
+    SEEN_ERROR_RATE = settings.get('seen_error_rate', 0.01)
+    SEEN_CACHE_SIZE = settings.get('seen_cache_size', 10000)
+    BREAKER_FAILURE_RATIO = settings.get('breaker_failure_ratio', 0.5)
+    BREAKER_SLOW_CALL = settings.get('breaker_slow_call', 5)
+    BREAKER_WINDOW = settings.get('breaker_window', 50)
+    BREAKER_MIN_CALLS = settings.get('breaker_min_calls', 10)
+    BREAKER_RESET_TIMEOUT = settings.get('breaker_reset_timeout', 30)
+    BREAKER_HALF_OPEN_CALLS = settings.get('breaker_half_open_calls', 3)
+    STALE_AFTER = settings.get('stale_after', 0)
+    REFRESH_THREADS = settings.get('refresh_threads', 2)
+    UPDATE_MODE = settings.get('update_mode', 'polling')
+    WEBHOOK_LISTEN = settings.get('webhook_listen', '127.0.0.1')
+    WEBHOOK_PORT = settings.get('webhook_port', 8443)
+    WEBHOOK_URL = settings.get('webhook_url')
+    WEBHOOK_SECRET = settings.get('webhook_secret')
+    WEBHOOK_QUEUE_SIZE = settings.get('webhook_queue_size', 1000)
+    OUTBOX = settings.get('outbox', False)
+    OUTBOX_RATE = settings.get('outbox_rate', 30)
+    OUTBOX_BURST = settings.get('outbox_burst', 30)
+    OUTBOX_CHAT_RATE = settings.get('outbox_chat_rate', 1)
+    OUTBOX_CHAT_BURST = settings.get('outbox_chat_burst', 3)
@@ -0,0 +1,96 @@
+"""
+This module contains a write-behind aggregator for popularity counters.
+"""
+
+import logging
+import threading
+
+from collections import Counter
+from concurrent.futures import Future
+
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+class CounterAggregator(object):
+    """
+    Accumulates counter increments in memory and hands them over to
+    ``apply`` as a ``{key: increment}`` mapping. Pending increments are
+    flushed every ``flush_interval`` seconds and as soon as there are
+    ``max_pending`` of them, which bounds what a crash can lose.
+
+    Until the aggregator is started, every increment is applied at once.
+    """
+
+    def __init__(self, apply, flush_interval, max_pending):
+        self.apply = apply
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.flushes = 0
+        self._pending = Counter()
+        self._pending_total = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def bump(self, key, amount=1):
+        with self._lock:
+            self._pending[key] += amount
+            self._pending_total += amount
+            full = self._pending_total >= self.max_pending
+        if full or self._thread is None:
+            self.flush()
+
+    def pending(self, key):
+        with self._lock:
+            return self._pending[key]
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+            self._pending_total = 0
+        if not pending:
+            return 0
+        try:
+            result = self.apply(dict(pending))
+        except Exception as err:
+            logging.exception(str(err))
+            self._restore(pending)
+            return 0
+        if isinstance(result, Future):
+            # applied behind the write queue, failures show up later
+            result.add_done_callback(
+                lambda future: self._restored(future, pending))
+        self.flushes += 1
+        return len(pending)
+
+    def _restore(self, pending):
+        # kept for the next flush rather than lost
+        with self._lock:
+            self._pending.update(pending)
+            self._pending_total += sum(pending.values())
+
+    def _restored(self, future, pending):
+        error = future.exception()
+        if error is not None:
+            logging.error('counter flush failed: %s', error)
+            self._restore(pending)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._flush_forever, name='counter_flusher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _flush_forever(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
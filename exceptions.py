@@ -5,3 +5,9 @@ This module contains the set of exceptions specified to yappi.
 
 class MultipleRecords(Exception):
     pass
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of calling an upstream while its circuit breaker is open.
+    """
@@ -0,0 +1,119 @@
+"""
+This module provides a pooled keep-alive HTTP session for the dictionary
+endpoint with timeouts and a bounded retry budget.
+"""
+
+import logging
+import random
+import threading
+import time
+
+from collections import deque
+
+import requests
+
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+class RetryBudget(object):
+    """
+    Token bucket limiting retries to a fraction of all calls, so a failing
+    upstream doesn't get hammered by retry storms.
+    """
+
+    def __init__(self, ratio, max_tokens=10.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class DictionarySession(object):
+
+    def __init__(self, connect_timeout, read_timeout, retries, backoff,
+                 pool_size, budget=None, sleep=time.sleep):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.budget = budget or RetryBudget(ratio=0.2)
+        self.sleep = sleep
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.calls = 0
+        self.failures = 0
+        self.latencies = deque(maxlen=1000)
+
+    def get(self, url):
+        backoffs = self.backoffs()
+        while True:
+            start = time.monotonic()
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as err:
+                self.record(start, failed=True)
+                delay = next(backoffs, None)
+                if delay is None:
+                    raise
+                logging.warning('dictionary request failed: %s', err)
+            else:
+                failed = response.status_code >= 500
+                self.record(start, failed=failed)
+                delay = next(backoffs, None) if failed else None
+                if delay is None:
+                    return response
+                logging.warning(
+                    'dictionary request failed: %s', response.status_code)
+            self.sleep(delay)
+
+    def backoffs(self):
+        """
+        Starts a call, returns an iterator of the delays before its
+        retries, exhausted once the retries or the budget are. Shared with
+        callers making the request themselves.
+        """
+        self.budget.deposit()
+        return self._backoffs()
+
+    def _backoffs(self):
+        for attempt in range(1, self.retries + 1):
+            if not self.budget.withdraw():
+                return
+            # full jitter exponential backoff
+            yield random.uniform(0, self.backoff * 2 ** attempt)
+
+    def record(self, start, failed):
+        """
+        Accounts for a call started at ``start``, also used by callers
+        making the request themselves.
+        """
+        self.calls += 1
+        latency = time.monotonic() - start
+        self.latencies.append(latency)
+        if failed:
+            self.failures += 1
+        logging.debug('dictionary request took %.3fs', latency)
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            'calls': self.calls,
+            'failures': self.failures,
+            'latency_avg': (sum(latencies) / len(latencies)
+                            if latencies else 0.0),
+            'latency_max': latencies[-1] if latencies else 0.0,
+        }
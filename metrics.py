@@ -0,0 +1,220 @@
+"""
+This module contains lightweight latency histograms and counters of the
+request stages, exported in the Prometheus text format to a file or over
+a local HTTP endpoint.
+
+Instrumentation is decided at import time: while metrics are disabled
+``timed`` hands functions back untouched.
+"""
+
+import bisect
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import config
+
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # the last one counts values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        # linear interpolation inside the bucket holding the rank
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[index - 1] if index else 0.0
+                if index == len(self.buckets):
+                    return lower
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Registry(object):
+
+    def __init__(self, enabled, prefix='yappi'):
+        self.enabled = enabled
+        self.prefix = prefix
+        self.stages = {}
+        self.counters = {}
+        self.collectors = {}
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        with self._lock:
+            return self.stages.setdefault(name, Histogram())
+
+    def counter(self, name):
+        with self._lock:
+            return self.counters.setdefault(name, Counter())
+
+    def collector(self, name, collect):
+        """
+        Registers ``collect``, a callable returning a dict of current
+        values, exported as gauges named ``<prefix>_<name>_<key>``.
+        """
+        self.collectors[name] = collect
+
+    def timed(self, stage):
+        def decorator(func):
+            if not self.enabled:
+                return func
+            histogram = self.stage(stage)
+            errors = self.counter('{}_errors'.format(stage))
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                except Exception:
+                    errors.inc()
+                    raise
+                finally:
+                    histogram.observe(time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def summary(self, quantiles=(0.5, 0.99)):
+        return [
+            (name, histogram.count,
+             [histogram.quantile(q) for q in quantiles])
+            for name, histogram in sorted(self.stages.items())
+        ]
+
+    def render(self):
+        lines = []
+        family = '{}_stage_seconds'.format(self.prefix)
+        if self.stages:
+            lines.append('# TYPE {} histogram'.format(family))
+        for name, histogram in sorted(self.stages.items()):
+            cumulative = 0
+            bounds = [repr(bound) for bound in histogram.buckets] + ['+Inf']
+            for bound, count in zip(bounds, histogram.counts):
+                cumulative += count
+                lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(
+                    family, name, bound, cumulative))
+            lines.append('{}_sum{{stage="{}"}} {!r}'.format(
+                family, name, histogram.sum))
+            lines.append('{}_count{{stage="{}"}} {}'.format(
+                family, name, histogram.count))
+        for name, counter in sorted(self.counters.items()):
+            metric = '{}_{}_total'.format(self.prefix, name)
+            lines.append('# TYPE {} counter'.format(metric))
+            lines.append('{} {}'.format(metric, counter.value))
+        for name, collect in sorted(self.collectors.items()):
+            try:
+                values = collect()
+            except Exception as err:
+                logging.exception(str(err))
+                continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, bool) or \
+                        not isinstance(value, (int, float)):
+                    continue
+                metric = '{}_{}_{}'.format(self.prefix, name, key)
+                lines.append('# TYPE {} gauge'.format(metric))
+                lines.append('{} {!r}'.format(metric, value))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        # written aside and renamed so readers never see a partial file
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile(
+                'w', dir=directory, delete=False) as textfile:
+            textfile.write(self.render())
+        os.replace(textfile.name, path)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(registry, port, host='127.0.0.1'):
+    server = HTTPServer((host, port), MetricsHandler)
+    server.registry = registry
+    thread = threading.Thread(
+        target=server.serve_forever, name='metrics_http', daemon=True)
+    thread.start()
+    return server
+
+
+def _write_textfile(registry, path, interval):
+    while True:
+        try:
+            registry.write_textfile(path)
+        except Exception as err:
+            logging.exception(str(err))
+        time.sleep(interval)
+
+
+def start():
+    if not registry.enabled:
+        return
+    if config.Config.METRICS_FILE:
+        threading.Thread(
+            target=_write_textfile,
+            args=(registry, config.Config.METRICS_FILE,
+                  config.Config.METRICS_INTERVAL),
+            name='metrics_textfile', daemon=True
+        ).start()
+    if config.Config.METRICS_PORT:
+        serve(registry, config.Config.METRICS_PORT)
+
+
+registry = Registry(enabled=config.Config.METRICS)
+timed = registry.timed
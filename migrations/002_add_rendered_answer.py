@@ -0,0 +1,44 @@
+from playhouse.migrate import *
+
+import config
+from models import Request
+from templates import Translate
+from yadict import render_request
+
+DB_NAME = config.Config.DB_NAME
+CHUNK_SIZE = 500
+
+db = SqliteDatabase(DB_NAME)
+migrator = SqliteMigrator(db)
+
+columns = [column.name for column in db.get_columns('request')]
+
+if 'answer' not in columns:
+    migrate(
+        migrator.add_column('request', 'answer', TextField(default='')),
+        migrator.add_column('request', 'renderer', IntegerField(default=0)),
+    )
+
+last_id = 0
+rendered = 0
+while True:
+    chunk = list(
+        Request
+        .select(Request.id, Request.content, Request.raw)
+        .where((Request.id > last_id) &
+               (Request.renderer != Translate.VERSION))
+        .order_by(Request.id)
+        .limit(CHUNK_SIZE)
+    )
+    if not chunk:
+        break
+    with Request._meta.database.atomic():
+        for request in chunk:
+            (Request
+             .update(answer=render_request(request),
+                     renderer=Translate.VERSION)
+             .where(Request.id == request.id)
+             .execute())
+    last_id = chunk[-1].id
+    rendered += len(chunk)
+    print('rendered {} requests'.format(rendered))
@@ -0,0 +1,67 @@
+from playhouse.migrate import *
+
+import config
+
+DB_NAME = config.Config.DB_NAME
+
+db = SqliteDatabase(DB_NAME)
+migrator = SqliteMigrator(db)
+
+DEDUPE_REQUESTS = [
+    # every duplicate request row mapped to the oldest row with that content
+    """
+    CREATE TEMP TABLE request_dupes AS
+    SELECT r.id AS id, k.keep AS keep
+    FROM request r
+    JOIN (SELECT content, MIN(id) AS keep
+          FROM request GROUP BY content HAVING COUNT(*) > 1) k
+    ON r.content = k.content
+    WHERE r.id != k.keep
+    """,
+    """
+    UPDATE request
+    SET counter = (SELECT SUM(r.counter) FROM request r
+                   WHERE r.content = request.content)
+    WHERE id IN (SELECT keep FROM request_dupes)
+    """,
+    """
+    UPDATE message
+    SET request = (SELECT keep FROM request_dupes d WHERE d.id = message.request)
+    WHERE request IN (SELECT id FROM request_dupes)
+    """,
+    """
+    UPDATE firstrequest
+    SET request = (SELECT keep FROM request_dupes d
+                   WHERE d.id = firstrequest.request)
+    WHERE request IN (SELECT id FROM request_dupes)
+    """,
+    'DELETE FROM request WHERE id IN (SELECT id FROM request_dupes)',
+    """
+    DELETE FROM firstrequest WHERE id NOT IN (
+        SELECT MIN(id) FROM firstrequest GROUP BY request, chat, user)
+    """,
+    'DROP TABLE request_dupes',
+]
+
+with db.atomic():
+    create_dupes, rest = DEDUPE_REQUESTS[0], DEDUPE_REQUESTS[1:]
+    db.execute_sql(create_dupes)
+    dupes = db.execute_sql('SELECT COUNT(*) FROM request_dupes').fetchone()[0]
+    for statement in rest:
+        db.execute_sql(statement)
+    print('{} duplicate requests merged'.format(dupes))
+
+indexes = {
+    'request': [index.name for index in db.get_indexes('request')],
+    'firstrequest': [index.name for index in db.get_indexes('firstrequest')],
+}
+operations = []
+if 'request_content' not in indexes['request']:
+    operations.append(migrator.add_index('request', ('content',), True))
+if 'firstrequest_user' in indexes['firstrequest']:
+    operations.append(migrator.drop_index('firstrequest', 'firstrequest_user'))
+if 'firstrequest_request_chat_user' not in indexes['firstrequest']:
+    operations.append(migrator.add_index(
+        'firstrequest', ('request', 'chat', 'user'), True))
+
+migrate(*operations)
@@ -0,0 +1,17 @@
+from peewee import *
+
+import config
+from models import CallbackEntity
+
+DB_NAME = config.Config.DB_NAME
+
+db = SqliteDatabase(DB_NAME)
+
+# in-memory callbacks don't use the table at all
+if config.Config.CALLBACK_STORE == 'db':
+    keep = config.Config.CALLBACK_STORE_SIZE
+else:
+    keep = 0
+
+print('{} callbacks removed'.format(CallbackEntity.compact(keep)))
+db.execute_sql('VACUUM')
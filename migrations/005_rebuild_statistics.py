@@ -0,0 +1,4 @@
+# Recounts the materialized statistics from scratch, safe to rerun any time.
+from models import rebuild_statistics
+
+rebuild_statistics()
@@ -0,0 +1,64 @@
+# Converts plain text Request.raw values to the compressed format.
+# With --train it first builds the shared zlib dictionary out of the
+# stored answers and saves it to raw_dictionary.
+import os
+import sys
+
+from peewee import *
+
+import codec
+import config
+from models import Request
+
+DB_NAME = config.Config.DB_NAME
+CHUNK_SIZE = 500
+TRAIN_SAMPLES = 2000
+
+db = SqliteDatabase(DB_NAME)
+
+legacy = SQL("typeof(raw) = 'text'")
+
+if '--train' in sys.argv:
+    path = config.Config.RAW_DICTIONARY
+    if not path:
+        sys.exit('raw_dictionary is not configured')
+    # rows compressed with the old dictionary would become unreadable
+    if os.path.exists(path):
+        sys.exit('{} already exists'.format(path))
+    samples = [request.raw for request in
+               Request.select(Request.raw).order_by(fn.Random()).limit(TRAIN_SAMPLES)]
+    codec.dictionary = codec.train_dictionary(samples)
+    with open(path, 'wb') as dictionary:
+        dictionary.write(codec.dictionary)
+    print('trained {} byte dictionary on {} answers'.format(
+        len(codec.dictionary), len(samples)))
+
+last_id = 0
+before = after = converted = 0
+while True:
+    chunk = list(
+        Request
+        .select(Request.id, Request.raw)
+        .where((Request.id > last_id) & legacy)
+        .order_by(Request.id)
+        .limit(CHUNK_SIZE)
+    )
+    if not chunk:
+        break
+    database = Request._meta.database
+    with database.atomic():
+        for request in chunk:
+            value = codec.encode(request.raw, codec.dictionary)
+            before += len(request.raw.encode('utf-8'))
+            after += len(value)
+            # stored as encoded here, the field would encode it again
+            database.execute_sql(
+                'UPDATE request SET raw = ? WHERE id = ?', (value, request.id))
+    last_id = chunk[-1].id
+    converted += len(chunk)
+    print('converted {} requests'.format(converted))
+
+if converted:
+    print('raw size: {} -> {} bytes ({:.0%} saved)'.format(
+        before, after, 1 - after / before))
+db.execute_sql('VACUUM')
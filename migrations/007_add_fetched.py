@@ -0,0 +1,19 @@
+# Adds Request.fetched, the time the raw answer was fetched. Existing rows
+# are stamped with the current time so they don't all turn stale at once.
+import time
+
+from playhouse.migrate import *
+
+import config
+
+DB_NAME = config.Config.DB_NAME
+
+db = SqliteDatabase(DB_NAME)
+migrator = SqliteMigrator(db)
+
+columns = [column.name for column in db.get_columns('request')]
+
+if 'fetched' not in columns:
+    with db.atomic():
+        migrate(migrator.add_column('request', 'fetched', IntegerField(default=0)))
+        db.execute_sql('UPDATE request SET fetched = ?', (int(time.time()),))
@@ -1,11 +1,41 @@
+import logging
+import threading
+import time
+
 from peewee import *
 
+import cache
+import codec
 import config
+import counters
 import exceptions
+import metrics
+import writer
 
 DB_NAME = config.Config.DB_NAME
 
-db = SqliteDatabase(DB_NAME)
+db = SqliteDatabase(DB_NAME, pragmas=list(config.Config.SQLITE_PRAGMAS.items()))
+
+# all writes of the handlers go through this queue
+write_queue = writer.WriteQueue(
+    db,
+    max_batch=config.Config.WRITE_BATCH_SIZE,
+    max_latency=config.Config.WRITE_BATCH_LATENCY
+)
+
+
+class CompressedTextField(BlobField):
+    """
+    Stores JSON text in the compact format of the codec module.
+    """
+
+    def db_value(self, value):
+        if value is None:
+            return None
+        return codec.encode(value, codec.dictionary)
+
+    def python_value(self, value):
+        return codec.decode(value, codec.dictionary)
 
 
 class BaseModel(Model):
@@ -18,10 +48,33 @@ class User(BaseModel):
     tid = IntegerField(unique=True)
     name = CharField()
 
+    @classmethod
+    def resolve(cls, tid, name):
+        pk = cache.users.get(tid)
+        if pk is not None:
+            return User(id=pk, tid=tid, name=name)
+        user, created = write_queue.submit(
+            User.get_or_create, tid=tid, defaults={'name': name}).result()
+        # new rows are cached on the next lookup, once they are committed
+        if not created:
+            cache.users.put(tid, user.id)
+        return user
+
 
 class Chat(BaseModel):
     chat_id = IntegerField(default=0)
 
+    @classmethod
+    def resolve(cls, chat_id):
+        pk = cache.chats.get(chat_id)
+        if pk is not None:
+            return Chat(id=pk, chat_id=chat_id)
+        chat, created = write_queue.submit(
+            Chat.get_or_create, chat_id=chat_id).result()
+        if not created:
+            cache.chats.put(chat_id, chat.id)
+        return chat
+
 
 class CallbackEntity(BaseModel):
     data = CharField()
@@ -33,31 +86,150 @@ class CallbackEntity(BaseModel):
 
     @classmethod
     def get_callback(cls, index):
-        query = CallbackEntity.select().where(CallbackEntity.id == index)
-        if not query:
-            return
-        data = query[0].data
-        query[0].delete_instance()
-        return data
+        with db.atomic():
+            query = CallbackEntity.select().where(CallbackEntity.id == index)
+            if not query:
+                return
+            data = query[0].data
+            query[0].delete_instance()
+            return data
+
+    @classmethod
+    def compact(cls, keep):
+        last = CallbackEntity.select(fn.MAX(CallbackEntity.id)).scalar()
+        if last is None:
+            return 0
+        return (CallbackEntity
+                .delete()
+                .where(CallbackEntity.id <= last - keep)
+                .execute())
 
 
 class Request(BaseModel):
-    content = CharField(default='')
-    raw = CharField(default='')
+    content = CharField(default='', unique=True)
+    raw = CompressedTextField(default='')
     counter = IntegerField(default=1)
+    answer = TextField(default='')
+    renderer = IntegerField(default=0)
+    fetched = IntegerField(default=0)
+
+    def save(self, force_insert=False, only=None):
+        # counter bumps don't change the rendered answer
+        if {'content', 'raw', 'answer'} & self._dirty:
+            cache.answers.invalidate(self.content)
+        if 'content' in self._dirty and self._get_pk_value() is not None:
+            # a renamed row leaves its answer cached under the old content
+            previous = (Request
+                        .select(Request.content)
+                        .where(Request.id == self._get_pk_value())
+                        .scalar())
+            if previous is not None:
+                cache.answers.invalidate(previous)
+        inserted = force_insert or self._get_pk_value() is None
+        rows = super().save(force_insert=force_insert, only=only)
+        if inserted:
+            seen_requests.add(self.content)
+        return rows
+
+    def delete_instance(self, *args, **kwargs):
+        cache.answers.invalidate(self.content)
+        return super().delete_instance(*args, **kwargs)
 
     @classmethod
-    @db.atomic()
+    def lookup(cls):
+        """
+        Selects every column but raw, which is decompressed when read and
+        only needed to render an answer again, see ``load_raw``.
+        """
+        return cls.select(*[field for field in cls._meta.sorted_fields
+                            if field is not cls.raw])
+
+    def load_raw(self):
+        if not self.raw:
+            self.raw = (Request
+                        .select(Request.raw)
+                        .where(Request.id == self.id)
+                        .get()
+                        .raw)
+            # loaded, not changed
+            self._dirty.discard('raw')
+        return self.raw
+
+    @classmethod
+    @metrics.timed('get_request')
     def get_request(cls, content):
-        query = Request.select().where(Request.content == content.lower())
+        content = content.lower()
+        if not seen_requests.might_contain(content):
+            return
+        query = Request.lookup().where(Request.content == content)
         if not query:
             return
         if len(query) > 1:
             raise exceptions.MultipleRecords
+        # the row itself is left alone, the increment is written behind
         query[0].counter += 1
-        query[0].save()
+        popularity.bump(query[0].id)
         return query[0]
 
+    @classmethod
+    def add_counters(cls, increments):
+        database = Request._meta.database
+        sql = 'UPDATE {} SET counter = counter + ? WHERE id = ?'.format(
+            Request._meta.db_table)
+        with database.atomic():
+            database.get_cursor().executemany(
+                sql, [(amount, pk) for pk, amount in increments.items()])
+
+    @classmethod
+    def refresh(cls, content, raw, answer, renderer):
+        (Request
+         .update(raw=raw, answer=answer, renderer=renderer,
+                 fetched=int(time.time()))
+         .where(Request.content == content)
+         .execute())
+        cache.answers.put(content, answer)
+
+    @classmethod
+    def insert_or_get(cls, content, **fields):
+        # relies on the unique index on content, so concurrent inserts
+        # of the same content end up with a single row
+        try:
+            with db.atomic():
+                request = Request.create(content=content, **fields)
+                Statistic.bump(Statistic.REQUESTS)
+                return request, True
+        except IntegrityError:
+            return Request.get(Request.content == content), False
+
+
+class NegativeResult(BaseModel):
+    content = CharField(unique=True)
+    expires = IntegerField(default=0)
+
+    @classmethod
+    def get_expiry(cls, content):
+        # expired rows are left to the upsert of remember(), handlers
+        # don't write inside their transactions
+        query = (NegativeResult
+                 .select(NegativeResult.expires)
+                 .where((NegativeResult.content == content) &
+                        (NegativeResult.expires > int(time.time()))))
+        if not query:
+            return
+        return query[0].expires
+
+    @classmethod
+    def remember(cls, content, ttl):
+        expires = int(time.time() + ttl)
+        NegativeResult.insert(content=content, expires=expires).upsert().execute()
+
+
+popularity = counters.CounterAggregator(
+    apply=lambda increments: write_queue.submit(Request.add_counters, increments),
+    flush_interval=config.Config.COUNTER_FLUSH_INTERVAL,
+    max_pending=config.Config.COUNTER_MAX_PENDING
+)
+
 
 class Message(BaseModel):
     chat = ForeignKeyField(Chat, related_name='chat', db_column='chat')
@@ -70,15 +242,40 @@ class Message(BaseModel):
 class FirstRequest(BaseModel):
     request = ForeignKeyField(Request, related_name='fr_request', db_column='request')
     chat = ForeignKeyField(Chat, related_name='fr_chat', db_column='chat')
-    user = ForeignKeyField(User, related_name='fr_user', db_column='user', unique=True)
+    user = ForeignKeyField(User, related_name='fr_user', db_column='user')
     message = ForeignKeyField(Message, related_name='fr_message', db_column='message')
     reply_to = IntegerField(default=0)
 
+    class Meta:
+        indexes = (
+            (('request', 'chat', 'user'), True),
+        )
+
     @classmethod
+    def create(cls, **query):
+        with db.atomic():
+            inst = super().create(**query)
+            UserStatistic.bump(inst.user_id)
+        seen_first_requests.add(
+            first_request_key(inst.request_id, inst.chat_id, inst.user_id))
+        return inst
+
+    @classmethod
+    @metrics.timed('get_first_request_and_request')
     def get_first_request_and_request(cls, content, chat, user):
         request = Request.get_request(content=content)
         if not request:
             return None, None
+        return cls.get_first_request(request, chat, user), request
+
+    @classmethod
+    def get_first_request(cls, request, chat, user):
+        key = first_request_key(request.id, chat.id, user.id)
+        if not seen_first_requests.might_contain(key):
+            return
+        first_request = cache.first_requests.get(key)
+        if first_request is not None:
+            return first_request
         query = (FirstRequest
                  .select()
                  .where(
@@ -87,27 +284,150 @@ class FirstRequest(BaseModel):
                      (FirstRequest.user == user.id))
                  )
         if not query:
-            return None, request
-        return query[0], request
+            return
+        cache.first_requests.put(key, query[0])
+        return query[0]
 
     @classmethod
     def statistics(cls):
         query = (
-            User
-            .select(User.name, fn.COUNT(FirstRequest.id).alias('num_requests'))
-            .join(FirstRequest, JOIN.LEFT_OUTER)
-            .group_by(User.name)
-            .order_by(SQL('num_requests').desc())
+            UserStatistic
+            .select(User.name, UserStatistic.num_requests)
+            .join(User)
+            .order_by(UserStatistic.num_requests.desc())
+            .naive()
         )
 
-        return [(user.name, user.num_requests)
-                for user in query.aggregate_rows()]
+        return [(stat.name, stat.num_requests) for stat in query]
+
+
+class Statistic(BaseModel):
+    """
+    Counters maintained along with the rows they count, so reading
+    statistics doesn't depend on the size of the database.
+    """
+    REQUESTS = 'requests'
+
+    name = CharField(unique=True)
+    value = IntegerField(default=0)
+
+    @classmethod
+    def bump(cls, name, amount=1):
+        Statistic.insert(name=name, value=0).on_conflict('IGNORE').execute()
+        (Statistic
+         .update(value=Statistic.value + amount)
+         .where(Statistic.name == name)
+         .execute())
+
+    @classmethod
+    def get_value(cls, name):
+        query = Statistic.select().where(Statistic.name == name)
+        if not query:
+            return 0
+        return query[0].value
+
+
+class UserStatistic(BaseModel):
+    user = ForeignKeyField(User, related_name='statistic', db_column='user', unique=True)
+    num_requests = IntegerField(default=0)
+
+    @classmethod
+    def bump(cls, user_id, amount=1):
+        UserStatistic.insert(user=user_id).on_conflict('IGNORE').execute()
+        (UserStatistic
+         .update(num_requests=UserStatistic.num_requests + amount)
+         .where(UserStatistic.user == user_id)
+         .execute())
+
+
+def first_request_key(request_id, chat_id, user_id):
+    return '{}:{}:{}'.format(request_id, chat_id, user_id)
+
+
+def _request_keys():
+    query = Request.select(Request.content).tuples()
+    for content, in stream(query):
+        yield content
+
+
+def _first_request_keys():
+    query = (FirstRequest
+             .select(FirstRequest.request, FirstRequest.chat, FirstRequest.user)
+             .tuples())
+    for request_id, chat_id, user_id in stream(query):
+        yield first_request_key(request_id, chat_id, user_id)
+
+
+seen_requests = cache.SeenIndex(
+    _request_keys,
+    capacity=config.Config.SEEN_CAPACITY,
+    error_rate=config.Config.SEEN_ERROR_RATE
+)
+seen_first_requests = cache.SeenIndex(
+    _first_request_keys,
+    capacity=config.Config.SEEN_CAPACITY,
+    error_rate=config.Config.SEEN_ERROR_RATE
+)
+
+
+def _load_seen():
+    try:
+        seen_requests.load()
+        seen_first_requests.load()
+    except Exception as err:
+        logging.exception(str(err))
+    finally:
+        db.close()
+
+
+def start_seen():
+    # handlers ask the database until the filters are loaded
+    thread = threading.Thread(target=_load_seen, name='seen_index', daemon=True)
+    thread.start()
+    return thread
+
+
+def save_first_request(request, chat, user, message, reply_to):
+    message.request = request
+    message.save()
+    FirstRequest.create(
+        request=request,
+        chat=chat,
+        user=user,
+        message=message,
+        reply_to=reply_to
+    )
+
+
+def stream(query):
+    # rows are fetched from the cursor one by one and never cached,
+    # unlike query.iterator() this doesn't leak StopIteration (PEP 479)
+    results = query.execute()
+    while True:
+        try:
+            yield results.iterate()
+        except StopIteration:
+            return
+
+
+def rebuild_statistics():
+    with db.atomic():
+        Statistic.delete().execute()
+        UserStatistic.delete().execute()
+        Statistic.insert(
+            name=Statistic.REQUESTS, value=Request.select().count()).execute()
+        UserStatistic.insert_from(
+            fields=[UserStatistic.user, UserStatistic.num_requests],
+            query=(FirstRequest
+                   .select(FirstRequest.user, fn.COUNT(FirstRequest.id))
+                   .group_by(FirstRequest.user))
+        ).execute()
 
 
 def create_tables():
     with db.transaction():
-        for model in [CallbackEntity, Request, User, Chat, FirstRequest, Message]:
-            if not model.table_exists():
-                db.create_table(model)
+        for model in [CallbackEntity, Request, User, Chat, FirstRequest, Message,
+                      NegativeResult, Statistic, UserStatistic]:
+            model.create_table(fail_silently=True)
 
 create_tables()
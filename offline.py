@@ -0,0 +1,158 @@
+"""
+This module provides a read-only on-disk dictionary index, looked up
+through a memory map so only the touched pages are ever loaded.
+
+File layout (integers are little-endian unsigned):
+
+    header   magic b'YIDX', version (4 bytes), entries (4), table offset (8)
+    records  raw JSON answers, one after another
+    keys     utf-8 encoded keys, one after another
+    table    per entry sorted by key: key offset (8), key length (4),
+             record offset (8), record length (4)
+"""
+
+import json
+import mmap
+import os
+import string
+import struct
+import sys
+import tempfile
+import threading
+
+import config
+
+MAGIC = b'YIDX'
+VERSION = 1
+HEADER = struct.Struct('<4sIIQ')
+ENTRY = struct.Struct('<QIQI')
+
+
+def index_key(data):
+    # same normalization as requests get in yadict.normalize
+    defenition = data.get('def')
+    if not defenition:
+        return
+    text = defenition[0]['text']
+    text = text.translate(str.maketrans('', '', string.punctuation))
+    return text.lower().strip()
+
+
+def build_index(lines, path):
+    """
+    Streams JSON Lines answers of the lookup API into an index file at
+    ``path``. Only keys and offsets are kept in memory. The last answer
+    wins for duplicate keys. Returns the number of indexed entries.
+    """
+    entries = {}
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as index:
+        try:
+            index.write(HEADER.pack(MAGIC, VERSION, 0, 0))
+            for line in lines:
+                if isinstance(line, bytes):
+                    line = line.decode('utf-8')
+                line = line.strip()
+                if not line:
+                    continue
+                key = index_key(json.loads(line))
+                if not key:
+                    continue
+                record = line.encode('utf-8')
+                entries[key.encode('utf-8')] = (index.tell(), len(record))
+                index.write(record)
+
+            keys = sorted(entries)
+            key_offsets = []
+            for key in keys:
+                key_offsets.append(index.tell())
+                index.write(key)
+            table_offset = index.tell()
+            for key, key_offset in zip(keys, key_offsets):
+                record_offset, record_length = entries[key]
+                index.write(ENTRY.pack(
+                    key_offset, len(key), record_offset, record_length))
+            index.seek(0)
+            index.write(HEADER.pack(MAGIC, VERSION, len(keys), table_offset))
+        except BaseException:
+            os.unlink(index.name)
+            raise
+    os.replace(index.name, path)
+    return len(keys)
+
+
+class OfflineIndex(object):
+
+    def __init__(self, path):
+        with open(path, 'rb') as index:
+            self._map = mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.entries, self.table_offset = HEADER.unpack_from(
+            self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise ValueError('{} is not a dictionary index'.format(path))
+
+    def __len__(self):
+        return self.entries
+
+    def _entry(self, position):
+        return ENTRY.unpack_from(
+            self._map, self.table_offset + position * ENTRY.size)
+
+    def _key(self, entry):
+        key_offset, key_length, _, _ = entry
+        return self._map[key_offset:key_offset + key_length]
+
+    def get(self, key):
+        key = key.encode('utf-8')
+        low, high = 0, self.entries
+        while low < high:
+            middle = (low + high) // 2
+            entry = self._entry(middle)
+            current = self._key(entry)
+            if current < key:
+                low = middle + 1
+            elif current > key:
+                high = middle
+            else:
+                _, _, record_offset, record_length = entry
+                record = self._map[record_offset:record_offset + record_length]
+                return record.decode('utf-8')
+        return
+
+    def close(self):
+        self._map.close()
+
+
+_index = None
+_lock = threading.Lock()
+
+
+def get_index():
+    global _index
+    path = config.Config.OFFLINE_INDEX
+    if not path or not os.path.exists(path):
+        return
+    if _index is None:
+        with _lock:
+            if _index is None:
+                _index = OfflineIndex(path)
+    return _index
+
+
+def lookup(content):
+    index = get_index()
+    if index is None:
+        return
+    return index.get(content)
+
+
+def main():
+    if len(sys.argv) != 3:
+        sys.exit('usage: python offline.py <dump.jsonl> <index file>')
+    with open(sys.argv[1], 'rb') as dump:
+        print('indexed {} entries'.format(build_index(dump, sys.argv[2])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+"""
+This module contains a rate-limited scheduler of outgoing Telegram
+messages.
+
+Messages are paced by a global token bucket and one per chat, so bursts
+stay under the flood limits instead of failing with RetryAfter. Edits of
+existing messages go out before new messages, and edits of a message
+still waiting to be sent are coalesced into the latest one.
+"""
+
+import logging
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import Future
+
+from telegram.error import RetryAfter
+
+import config
+import metrics
+
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+SEND = 'send_message'
+EDIT = 'edit_message_text'
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self._updated = clock()
+
+    def _refill(self, now):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, now=None):
+        """
+        Seconds until a token is available, 0 if there is one now.
+        """
+        self._refill(self.clock() if now is None else now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    @property
+    def full(self):
+        self._refill(self.clock())
+        return self.tokens >= self.capacity
+
+
+class _Message(object):
+    __slots__ = ('method', 'bot', 'chat_id', 'args', 'kwargs', 'futures',
+                 'enqueued')
+
+    def __init__(self, method, bot, chat_id, args, kwargs, enqueued):
+        self.method = method
+        self.bot = bot
+        self.chat_id = chat_id
+        self.args = args
+        self.kwargs = kwargs
+        self.futures = [Future()]
+        self.enqueued = enqueued
+
+    @property
+    def key(self):
+        return self.chat_id, self.kwargs.get('message_id')
+
+    def deliver(self):
+        if self.method == SEND:
+            return self.bot.send_message(self.chat_id, *self.args, **self.kwargs)
+        return self.bot.edit_message_text(
+            *self.args, chat_id=self.chat_id, **self.kwargs)
+
+
+class Outbox(object):
+    """
+    Messages are delivered by a dedicated thread, ``send`` and ``edit``
+    return futures of the results of the Bot API calls.
+
+    Until the outbox is started, and once it is stopping, messages are
+    sent inline in the calling thread.
+    """
+
+    def __init__(self, rate, burst, chat_rate, chat_burst, max_chats=10000,
+                 clock=time.monotonic):
+        self.clock = clock
+        self.bucket = TokenBucket(rate, burst, clock)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self.sent = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.waiting = metrics.registry.stage('outbox_queue')
+        self._edits = deque()
+        self._sends = deque()
+        self._pending_edits = {}
+        self._chats = {}
+        self._paused_until = 0.0
+        self._stopping = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def send(self, bot, chat_id, *args, **kwargs):
+        return self._submit(_Message(
+            SEND, bot, chat_id, args, kwargs, self.clock()))
+
+    def edit(self, bot, chat_id, message_id, *args, **kwargs):
+        kwargs['message_id'] = message_id
+        return self._submit(_Message(
+            EDIT, bot, chat_id, args, kwargs, self.clock()))
+
+    def _submit(self, message):
+        future = message.futures[0]
+        with self._condition:
+            # the final drain of a stopping outbox may be over already
+            queued = self.running and not self._stopping
+            if queued:
+                self._enqueue(message)
+        if not queued:
+            future.set_result(message.deliver())
+        return future
+
+    def _enqueue(self, message):
+        if message.method == EDIT:
+            pending = self._pending_edits.get(message.key)
+            if pending is not None:
+                # only the latest text of a message is worth sending
+                pending.args = message.args
+                pending.kwargs = message.kwargs
+                pending.futures.extend(message.futures)
+                self.coalesced += 1
+                return
+            self._pending_edits[message.key] = message
+            self._edits.append(message)
+        else:
+            self._sends.append(message)
+        self._condition.notify()
+
+    def start(self):
+        if self.running:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(
+            target=self._run, name='outbox', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    message, delay = self._next()
+                    if message is not None:
+                        break
+                    if delay is None and self._stopping:
+                        return
+                    self._condition.wait(delay)
+            self._deliver(message)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.max_chats:
+                # buckets refilled to the brim are as good as new ones
+                self._chats = {chat: bucket for chat, bucket
+                               in self._chats.items() if not bucket.full}
+            bucket = self._chats[chat_id] = TokenBucket(
+                self.chat_rate, self.chat_burst, self.clock)
+        return bucket
+
+    def _next(self):
+        """
+        Takes the first message allowed out now, edits before sends.
+        Returns (message, None) or (None, seconds to wait), where None
+        waits for a new message.
+        """
+        if not self._edits and not self._sends:
+            return None, None
+        now = self.clock()
+        if self._paused_until > now:
+            return None, self._paused_until - now
+        delay = self.bucket.delay(now)
+        if delay:
+            return None, delay
+        delays = []
+        for queue in (self._edits, self._sends):
+            for message in queue:
+                bucket = self._chat_bucket(message.chat_id)
+                delay = bucket.delay(now)
+                if delay:
+                    delays.append(delay)
+                    continue
+                bucket.consume()
+                self.bucket.consume()
+                queue.remove(message)
+                if message.method == EDIT:
+                    del self._pending_edits[message.key]
+                return message, None
+        return None, min(delays)
+
+    def _deliver(self, message):
+        self.waiting.observe(self.clock() - message.enqueued)
+        try:
+            result = message.deliver()
+        except RetryAfter as err:
+            logging.warning('outbox paused for %.1fs', err.retry_after)
+            self._retry(message, err.retry_after)
+            return
+        except Exception as err:
+            logging.exception(str(err))
+            for future in message.futures:
+                future.set_exception(err)
+            return
+        self.sent += 1
+        for future in message.futures:
+            future.set_result(result)
+
+    def _retry(self, message, delay):
+        with self._condition:
+            self.retries += 1
+            self._paused_until = self.clock() + delay
+            if message.method == SEND:
+                self._sends.appendleft(message)
+                return
+            pending = self._pending_edits.get(message.key)
+            if pending is not None:
+                # a newer edit of the message came meanwhile
+                pending.futures.extend(message.futures)
+                return
+            self._pending_edits[message.key] = message
+            self._edits.appendleft(message)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'edits': len(self._edits),
+                'sends': len(self._sends),
+                'sent': self.sent,
+                'coalesced': self.coalesced,
+                'retries': self.retries,
+            }
+
+
+scheduler = Outbox(
+    rate=config.Config.OUTBOX_RATE,
+    burst=config.Config.OUTBOX_BURST,
+    chat_rate=config.Config.OUTBOX_CHAT_RATE,
+    chat_burst=config.Config.OUTBOX_CHAT_BURST
+)
@@ -0,0 +1,147 @@
+"""
+This module contains a local spelling index over every stored request and
+an optional word list, so typos are corrected without a round-trip to the
+network speller.
+
+Candidates are generated from the misspelled word (every edit of it over
+the alphabet of known words) and looked up in a hash of known words, so
+a correction costs a few hundred lookups and the index itself is no
+bigger than the set of words.
+"""
+
+import logging
+import os
+import threading
+
+import config
+
+from models import db, stream, Request
+
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+def edits(word, alphabet):
+    """
+    Every string one deletion, transposition, substitution or insertion
+    away from ``word``.
+    """
+    splits = [(word[:i], word[i:]) for i in range(len(word) + 1)]
+    for left, right in splits:
+        if right:
+            yield left + right[1:]
+        if len(right) > 1:
+            yield left + right[1] + right[0] + right[2:]
+        for char in alphabet:
+            if right:
+                yield left + char + right[1:]
+            yield left + char + right
+
+
+class Correction(object):
+    """
+    Local suggestion with the attributes of ``pyaspeller.Word`` that
+    ``yadict.answer_spellcheck`` relies on.
+    """
+    correct = False
+
+    def __init__(self, word, spellsafe):
+        self.word = word
+        self.spellsafe = spellsafe
+
+
+class SpellingIndex(object):
+
+    def __init__(self, max_distance, words_path=None):
+        self.max_distance = max_distance
+        self.words_path = words_path
+        self.loaded = False
+        self._weights = {}
+        self._alphabet = ''
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._weights)
+
+    def __contains__(self, word):
+        # unknown until loaded, handlers never wait for the load
+        return self.loaded and word in self._weights
+
+    def _add(self, word, weight):
+        if word not in self._weights:
+            letters = set(word)
+            if not letters.issubset(self._alphabet):
+                # replaced, not updated, as suggest() iterates it unlocked
+                self._alphabet = ''.join(sorted(letters.union(self._alphabet)))
+        self._weights[word] = max(self._weights.get(word, 0), weight)
+
+    def add(self, word, weight=0):
+        with self._lock:
+            self._add(word, weight)
+
+    def load(self):
+        if self.loaded:
+            return
+        with self._lock:
+            if self.loaded:
+                return
+            if self.words_path and os.path.exists(self.words_path):
+                with open(self.words_path, encoding='utf-8') as words:
+                    for line in words:
+                        word = line.strip().lower()
+                        if word:
+                            self._add(word, 0)
+            query = (Request
+                     .select(Request.content, Request.counter)
+                     .naive())
+            for request in stream(query):
+                self._add(request.content, request.counter)
+            self.loaded = True
+        logging.info('spelling index: %d words', len(self._weights))
+
+    def suggest(self, word):
+        """
+        Returns the closest known word to an unknown ``word``, the most
+        requested one among equally close words, or None.
+        """
+        if not self.loaded or not word or word in self._weights:
+            return
+        # one typo per four letters, at most max_distance
+        limit = min(self.max_distance, max(1, len(word) // 4))
+        alphabet = self._alphabet
+        candidates = {word}
+        for _ in range(limit):
+            candidates = {edit for candidate in candidates
+                          for edit in edits(candidate, alphabet)}
+            known = [candidate for candidate in candidates
+                     if candidate in self._weights]
+            if known:
+                return max(known, key=lambda known_word: (
+                    self._weights.get(known_word, 0), known_word))
+
+    def reset(self):
+        with self._lock:
+            self._weights = {}
+            self._alphabet = ''
+            self.loaded = False
+
+
+def _load():
+    try:
+        index.load()
+    except Exception as err:
+        logging.exception(str(err))
+    finally:
+        db.close()
+
+
+def start():
+    thread = threading.Thread(target=_load, name='spelling_index', daemon=True)
+    thread.start()
+    return thread
+
+
+index = SpellingIndex(
+    max_distance=config.Config.SPELLING_MAX_DISTANCE,
+    words_path=config.Config.SPELLING_WORDS
+)
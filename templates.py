@@ -7,14 +7,21 @@ class MessageTemplate(object):
     CALLBACK_DATA_MISSING = 'Can\'t identify your request :('
     USER_STATS_LINE = '*{}:* {}\n'
     TOTAL_ENTITIES = '*Total:* {}\n'
+    HIT_RATE_LINE = '*{}:* {:.0%} hits\n'
     ALREADY_REQUESTED = 'You\'ve already requested that!'
     CANT_FIND = 'Sorry, can\'t find anything for `{}`.'
     EMPTY_REQUEST = 'Your request is empty. Try again.'
     ONLY_TILDE = 'There is only tilde, so check your input.'
     BOOKMARK = '❤'
+    LATENCY_LINE = '*{}:* p50 {:.1f}ms, p99 {:.1f}ms ({} calls)\n'
+    METRICS_DISABLED = 'Metrics are disabled.'
+    DICTIONARY_UNAVAILABLE = ('The dictionary is unavailable right now, '
+                              'try again in a minute.')
 
 
 class Translate(object):
+    # bump on any change below so stored answers get re-rendered
+    VERSION = 1
     HEAD = '`>>> {caption}`\n{answer}'
     POS = '_{}_'
     TRANSCRIPTION = '   `[{}]`{}'
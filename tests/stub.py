@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+
+def dummy_definition(text):
+    return {
+        'text': text,
+        'pos': 'noun',
+        'ts': text,
+        'tr': [{'text': text[::-1], 'mean': [{'text': text}]}]
+    }
+
+
+class StubDictionaryServer(ThreadingMixIn, HTTPServer):
+    """
+    Local stand-in for the dictionary lookup endpoint.
+
+    Words listed in ``missing`` get an empty definition, every other word
+    gets a dummy one. ``failures`` first requests are answered with 503.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, failures=0, missing=()):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.latency = latency
+        self.failures = failures
+        self.missing = set(missing)
+        self.requests = []
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def endpoint(self):
+        return 'http://127.0.0.1:{}/lookup?'.format(self.server_address[1])
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes, don't let them wait
+    # for delayed acks of keep-alive clients
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        text = parse_qs(urlparse(self.path).query).get('text', [''])[0]
+        server.requests.append(text)
+        if server.latency:
+            time.sleep(server.latency)
+        if server.failures > 0:
+            server.failures -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if text in server.missing:
+            defenition = []
+        else:
+            defenition = [dummy_definition(text)]
+        body = json.dumps({'head': {}, 'def': defenition}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Sent(object):
+
+    def __init__(self, message_id, chat_id, text):
+        self.message_id = message_id
+        self.chat_id = chat_id
+        self.text = text
+
+
+class FakeTransport(object):
+    """
+    Stand-in for the bot in outbox tests. Records every call with its
+    time and blocks while ``gate`` is cleared; errors queued in
+    ``failures`` are raised by the first calls.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.failures = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self._ids = iter(range(1, 1000000))
+
+    def _call(self, method, chat_id, text):
+        self.gate.wait()
+        if self.failures:
+            raise self.failures.pop(0)
+        self.calls.append((method, chat_id, text, time.monotonic()))
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._call('send', chat_id, text)
+        return Sent(next(self._ids), chat_id, text)
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        self._call('edit', chat_id, text)
+        return Sent(message_id, chat_id, text)
@@ -1,17 +1,49 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import json
+import os
+import queue
+import requests
+import tempfile
+import threading
+import time
 
+from concurrent.futures import Future
 from unittest import TestCase, main
 from unittest.mock import patch, MagicMock, call
 from playhouse.test_utils import test_database
+from telegram import Emoji
+from telegram.error import RetryAfter
+from telegram.ext import Filters, MessageHandler, Updater
 from peewee import *
 
+import aio
+import breaker
+import cache
+import callbacks
+import codec
+import config
+import counters
 import exceptions
+import httpclient
+import metrics
+import offline
+import outbox
+import singleflight
+import spelling
+import warmup
+import webhook
+import workers
+import writer
 import yadict
 
-from yappi import translate
-from models import CallbackEntity, Request, User, Chat, FirstRequest, Message
-from templates import MessageTemplate
+from yappi import (contextify, cut_lines, split_message, translate,
+                   translate_batch, translate_command, worker_queue_size)
+from models import (CallbackEntity, Request, User, Chat, FirstRequest, Message,
+                    NegativeResult, Statistic, UserStatistic, rebuild_statistics,
+                    seen_first_requests, seen_requests)
+from templates import MessageTemplate, Translate
+from tests.stub import FakeTransport, StubDictionaryServer, dummy_definition
 
 
 db = SqliteDatabase(':memory:')
@@ -25,6 +57,13 @@ def wrapped_load_content_from_db(request):
     return ORIGINAL['load_content_from_db'](request)
 
 
+def delivered(message_id):
+    # the future of a reply the outbox has sent already
+    future = Future()
+    future.set_result(MagicMock(message_id=message_id))
+    return future
+
+
 class TestModels(TestCase):
 
     @db.atomic()
@@ -63,13 +102,52 @@ class TestModels(TestCase):
             # check when only 1 unique record exists
             Request.create(content='test', raw='{"def": "test"}')
             request_query = Request.get_request(content='test')
-            self.assertEqual(request_query.raw, '{"def": "test"}')
+            # raw is left out of lookups, loaded when needed
+            self.assertEqual(request_query.raw, '')
+            self.assertEqual(request_query.load_raw(), '{"def": "test"}')
             self.assertEqual(request_query.counter, 2)
+            self.assertEqual(Request.get(Request.id == request_query.id).counter, 2)
 
-            # check when duplicates exist
-            Request.create(content='test', raw='{"def": "test"}')
-            with self.assertRaises(exceptions.MultipleRecords) as context:
-                request_query = Request.get_request(content='test')
+            # check that duplicates can't be created
+            with self.assertRaises(IntegrityError) as context:
+                Request.create(content='test', raw='{"def": "test"}')
+
+    @db.atomic()
+    def test_insert_or_get_request(self):
+        with test_database(db, (Request, Statistic)):
+            request, created = Request.insert_or_get(
+                content='test', raw='{"def": "test"}')
+            self.assertTrue(created)
+            same, created = Request.insert_or_get(
+                content='test', raw='{"def": "other"}')
+            self.assertFalse(created)
+            self.assertEqual(same.id, request.id)
+            self.assertEqual(same.raw, '{"def": "test"}')
+            self.assertEqual(len(Request.select()), 1)
+            self.assertEqual(Statistic.get_value(Statistic.REQUESTS), 1)
+
+    @db.atomic()
+    def test_statistics(self):
+        with test_database(db, (Chat, User, Request, Message, FirstRequest,
+                                 Statistic, UserStatistic)):
+            chat = Chat.create(chat_id=1)
+            users = [User.create(tid=i, name=str(i)) for i in range(3)]
+            for i in range(3):
+                request, _ = Request.insert_or_get(content=str(i), raw='')
+                for user in users[:i + 1]:
+                    message = Message.create(chat=chat, user=user)
+                    FirstRequest.create(
+                        request=request, chat=chat, user=user, message=message)
+
+            expected = [('0', 3), ('1', 2), ('2', 1)]
+            self.assertEqual(FirstRequest.statistics(), expected)
+            self.assertEqual(Statistic.get_value(Statistic.REQUESTS), 3)
+
+            Statistic.delete().execute()
+            UserStatistic.update(num_requests=0).execute()
+            rebuild_statistics()
+            self.assertEqual(FirstRequest.statistics(), expected)
+            self.assertEqual(Statistic.get_value(Statistic.REQUESTS), 3)
 
     @db.atomic()
     def test_create_message(self):
@@ -87,7 +165,8 @@ class TestModels(TestCase):
 
     @db.atomic()
     def test_create_first_request(self):
-        with test_database(db, (Chat, User, Request, Message, FirstRequest)):
+        with test_database(db, (Chat, User, Request, Message, FirstRequest,
+                                 Statistic, UserStatistic)):
             user, _ = User.get_or_create(tid=1, name='name')
             chat, _ = Chat.get_or_create(chat_id=1)
             request = Request.create(content='test', raw='{"def": "test"}')
@@ -106,6 +185,1438 @@ class TestModels(TestCase):
                     request=request, chat=chat, user=user, message=message)
 
 
+class TestFormat(TestCase):
+
+    def test_format_dict_message(self):
+        data = [
+            {'text': 'time', 'pos': 'noun', 'ts': 'taɪm', 'tr': [
+                {'text': 'время',
+                 'mean': [{'text': 'period'}, {'text': 'hour'}],
+                 'ex': [{'text': 'short time',
+                         'tr': [{'text': 'короткое время'}, {'text': 'миг'}]}]},
+                {'text': 'срок'}]},
+            {'pos': 'verb', 'tr': [{'text': 'засекать'}]},
+        ]
+        nbsp = '\xa0'
+        expected = (
+            '_noun_   `[taɪm]`\n' +
+            4 * nbsp + '*время*    `(period; hour)`\n' +
+            8 * nbsp + 'short time — короткое время/ миг\n' +
+            4 * nbsp + '*срок*\n' +
+            '_verb_\n' +
+            4 * nbsp + '*засекать*\n'
+        )
+        self.assertEqual(yadict.format_dict_message(data), expected)
+
+
+class TestCodec(TestCase):
+    RAW = '{\n    "head": {},\n    "def": [{"text": "тест", "pos": "noun"}]\n}'
+
+    def test_plain(self):
+        value = codec.encode(self.RAW)
+        self.assertEqual(value[0], codec.PLAIN)
+        self.assertEqual(
+            codec.decode(value),
+            '{"head": {}, "def": [{"text": "тест", "pos": "noun"}]}')
+        # values stored before compression are passed through
+        self.assertEqual(codec.decode(self.RAW), self.RAW)
+        self.assertEqual(codec.decode(codec.encode('not json')), 'not json')
+
+    def test_shared_dictionary(self):
+        dictionary = codec.train_dictionary([self.RAW] * 10)
+        self.assertIn(b'"pos": "noun"', dictionary)
+        value = codec.encode(self.RAW, dictionary)
+        self.assertEqual(value[0], codec.SHARED_DICTIONARY)
+        self.assertLess(len(value), len(codec.encode(self.RAW)))
+        self.assertEqual(codec.decode(value, dictionary),
+                         codec.decode(codec.encode(self.RAW)))
+        with patch('config.Config.RAW_DICTIONARY', None):
+            with self.assertRaises(ValueError):
+                codec.decode(value)
+
+        # a dictionary trained while the bot runs is picked up on first use
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'raw.zdict')
+            with open(path, 'wb') as trained:
+                trained.write(dictionary)
+            with patch('config.Config.RAW_DICTIONARY', path), \
+                    patch('codec.dictionary', None):
+                self.assertEqual(codec.decode(value),
+                                 codec.decode(codec.encode(self.RAW)))
+                self.assertEqual(codec.dictionary, dictionary)
+
+    @db.atomic()
+    def test_raw_field(self):
+        with test_database(db, (Request,)):
+            Request.create(content='test', raw=self.RAW)
+            stored = db.execute_sql('SELECT raw FROM request').fetchone()[0]
+            self.assertIsInstance(stored, bytes)
+            self.assertEqual(Request.get_request('test').load_raw(),
+                             codec.minify(self.RAW))
+
+    @db.atomic()
+    def test_lookup_skips_raw(self):
+        with test_database(db, (Request,)):
+            Request.create(content='test', raw=self.RAW, answer='answer',
+                           renderer=Translate.VERSION)
+            raw = json.dumps({'def': [dummy_definition('old')]})
+            Request.create(content='old', raw=raw, answer='outdated',
+                           renderer=0, counter=0)
+            cache.answers.clear()
+            with patch('codec.decode', wraps=codec.decode) as decode:
+                request = Request.get_request('test')
+                self.assertEqual(yadict.load_content_from_db(request), 'answer')
+                warmup.warm_up(1)
+                self.assertFalse(decode.called)
+                # only an outdated answer is rendered from raw again
+                cache.answers.clear()
+                request = Request.get_request('old')
+                self.assertEqual(
+                    yadict.load_content_from_db(request),
+                    yadict.format_dict_message([dummy_definition('old')]))
+                self.assertEqual(decode.call_count, 1)
+
+
+class TestCache(TestCase):
+
+    def test_lru_eviction(self):
+        lru = cache.LRUCache(max_entries=2)
+        lru.put('a', 'A')
+        lru.put('b', 'B')
+        self.assertEqual(lru.get('a'), 'A')
+        lru.put('c', 'C')
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('a'), 'A')
+        self.assertEqual(lru.get('c'), 'C')
+        self.assertEqual(lru.evictions, 1)
+        self.assertEqual(lru.hits, 3)
+        self.assertEqual(lru.misses, 1)
+        # membership tests don't count
+        self.assertIn('a', lru)
+        self.assertNotIn('b', lru)
+        self.assertEqual((lru.hits, lru.misses), (3, 1))
+
+    def test_size_bound(self):
+        lru = cache.LRUCache(
+            max_entries=10, max_bytes=10, sizeof=lambda k, v: len(v))
+        lru.put('a', 'x' * 6)
+        lru.put('b', 'x' * 6)
+        self.assertIsNone(lru.get('a'))
+        self.assertEqual(lru.size, 6)
+        # entries larger than the whole cache are not stored
+        lru.put('c', 'x' * 11)
+        self.assertIsNone(lru.get('c'))
+        self.assertEqual(lru.get('b'), 'x' * 6)
+
+    def test_ttl(self):
+        now = [0]
+        lru = cache.LRUCache(max_entries=10, ttl=5, clock=lambda: now[0])
+        lru.put('a', 'A')
+        now[0] = 4
+        self.assertEqual(lru.get('a'), 'A')
+        now[0] = 5
+        self.assertIsNone(lru.get('a'))
+        self.assertEqual(len(lru), 0)
+
+    @db.atomic()
+    def test_invalidate_on_rewrite(self):
+        with test_database(db, (Request,)):
+            cache.answers.clear()
+            request = Request.create(content='test', raw='{"def": []}')
+            cache.answers.put('test', 'answer')
+            request.counter += 1
+            request.save()
+            self.assertEqual(cache.answers.get('test'), 'answer')
+            request.raw = '{"def": [], "head": {}}'
+            request.save()
+            self.assertIsNone(cache.answers.get('test'))
+
+            cache.answers.put('test', 'answer')
+            request.content = 'renamed'
+            request.save()
+            self.assertIsNone(cache.answers.get('test'))
+
+    @db.atomic()
+    def test_rerender_outdated_answer(self):
+        with test_database(db, (Request,)):
+            cache.answers.clear()
+            raw = '{"def": [{"pos": "noun", "tr": [{"text": "тест"}]}]}'
+            Request.create(content='test', raw=raw, answer='stale', renderer=0)
+            request = Request.get(Request.content == 'test')
+            answer = yadict.load_content_from_db(request)
+            self.assertEqual(
+                answer, yadict.format_dict_message(json.loads(raw)['def']))
+
+            request = Request.get(Request.content == 'test')
+            self.assertEqual(request.answer, answer)
+            self.assertEqual(request.renderer, Translate.VERSION)
+
+            # up to date answers are served as stored
+            cache.answers.clear()
+            Request.update(answer='stored').execute()
+            request = Request.get(Request.content == 'test')
+            self.assertEqual(yadict.load_content_from_db(request), 'stored')
+
+    @db.atomic()
+    def test_warm_up(self):
+        with test_database(db, (Request,)):
+            cache.answers.clear()
+            raw = '{"def": [{"pos": "noun", "tr": [{"text": "тест"}]}]}'
+            for counter in range(1, 5):
+                Request.create(content=str(counter), raw=raw, counter=counter,
+                               answer=str(counter), renderer=Translate.VERSION)
+            Request.update(renderer=0).where(Request.content == '3').execute()
+
+            report = warmup.warm_up(limit=2)
+            self.assertEqual(report['entries'], 2)
+            self.assertEqual(report['coverage'], 0.7)
+            self.assertEqual(cache.answers.get('4'), '4')
+            self.assertEqual(cache.answers.get('3'),
+                             yadict.format_dict_message(json.loads(raw)['def']))
+            self.assertIsNone(cache.answers.get('2'))
+
+    @db.atomic()
+    @patch('yadict.dicservice_request')
+    def test_negative_cache(self, dicservice_request):
+        with test_database(db, (Request, NegativeResult)):
+            cache.misses.clear()
+            response = MagicMock()
+            response.text = '{"def": []}'
+            dicservice_request.return_value = response
+
+            self.assertFalse(yadict.is_known_miss('qwfp'))
+            self.assertEqual(yadict.load_content_from_api('qwfp'), ('', None))
+            self.assertTrue(yadict.is_known_miss('qwfp'))
+            self.assertEqual(len(NegativeResult.select()), 0)
+
+            with patch('config.Config.NEGATIVE_CACHE_PERSIST', True):
+                yadict.load_content_from_api('arst')
+                cache.misses.clear()
+                self.assertTrue(yadict.is_known_miss('arst'))
+                self.assertFalse(yadict.is_known_miss('qwfp'))
+
+                NegativeResult.update(expires=0).execute()
+                cache.misses.clear()
+                self.assertFalse(yadict.is_known_miss('arst'))
+                # expired rows are overwritten, not deleted on lookup
+                self.assertEqual(len(NegativeResult.select()), 1)
+                yadict.load_content_from_api('arst')
+                cache.misses.clear()
+                self.assertTrue(yadict.is_known_miss('arst'))
+                self.assertEqual(len(NegativeResult.select()), 1)
+
+
+class TestSeenIndex(TestCase):
+
+    def test_bloom_filter(self):
+        bloom = cache.BloomFilter(capacity=1000, error_rate=0.01)
+        for number in range(1000):
+            bloom.add('word{}'.format(number))
+        for number in range(1000):
+            self.assertIn('word{}'.format(number), bloom)
+        false_positives = sum(
+            'other{}'.format(number) in bloom for number in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_pending_keys(self):
+        loaded = ['first']
+        index = cache.SeenIndex(lambda: iter(loaded), capacity=100)
+        index.add('second')
+        self.assertFalse(index.loaded)
+        # unknown until loaded
+        self.assertTrue(index.might_contain('third'))
+        index.load()
+        self.assertTrue(index.might_contain('first'))
+        self.assertTrue(index.might_contain('second'))
+        self.assertFalse(index.might_contain('third'))
+        index.add('third')
+        self.assertTrue(index.might_contain('third'))
+
+    def test_add_while_loading(self):
+        scanning = threading.Event()
+        release = threading.Event()
+
+        def load_keys():
+            yield 'first'
+            scanning.set()
+            release.wait(5)
+
+        index = cache.SeenIndex(load_keys, capacity=100)
+        loader = threading.Thread(target=index.load)
+        loader.start()
+        self.assertTrue(scanning.wait(5))
+        # writers aren't held up by the scan of the table
+        adder = threading.Thread(target=index.add, args=('second',))
+        adder.start()
+        adder.join(1)
+        self.assertFalse(adder.is_alive())
+        release.set()
+        loader.join()
+        self.assertTrue(index.might_contain('first'))
+        self.assertTrue(index.might_contain('second'))
+        self.assertFalse(index.might_contain('third'))
+
+    @db.atomic()
+    def test_lookups_skip_database(self):
+        with test_database(db, (Chat, User, Request, Message, FirstRequest,
+                                 Statistic, UserStatistic)):
+            seen_requests.reset()
+            seen_first_requests.reset()
+            cache.first_requests.clear()
+            user = User.create(tid=1, name='name')
+            chat = Chat.create(chat_id=1)
+            message = Message.create(chat=chat, user=user, message_id=1, time=1)
+            request = Request.create(content='word')
+            seen_requests.load()
+            seen_first_requests.load()
+
+            with patch.object(Request, 'select') as select:
+                self.assertIsNone(Request.get_request('other'))
+            self.assertFalse(select.called)
+            self.assertEqual(Request.get_request('Word').id, request.id)
+
+            with patch.object(FirstRequest, 'select') as select:
+                self.assertIsNone(
+                    FirstRequest.get_first_request(request, chat, user))
+            self.assertFalse(select.called)
+
+            FirstRequest.create(request=request, chat=chat, user=user,
+                                message=message, reply_to=2)
+            self.assertEqual(
+                FirstRequest.get_first_request(request, chat, user).reply_to, 2)
+            # found once, served from memory afterwards
+            with patch.object(FirstRequest, 'select') as select:
+                self.assertEqual(FirstRequest.get_first_request(
+                    request, chat, user).reply_to, 2)
+            self.assertFalse(select.called)
+
+            # rows stored before the index is built are loaded from the table
+            seen_requests.reset()
+            seen_first_requests.reset()
+            cache.first_requests.clear()
+            self.assertEqual(Request.get_request('word').id, request.id)
+            self.assertEqual(
+                FirstRequest.get_first_request(request, chat, user).reply_to, 2)
+            self.assertFalse(seen_requests.loaded)
+
+
+class TestDictionarySession(TestCase):
+
+    def session(self, **kwargs):
+        params = dict(connect_timeout=1, read_timeout=1, retries=2,
+                      backoff=0, pool_size=2, sleep=lambda _: None)
+        params.update(kwargs)
+        return httpclient.DictionarySession(**params)
+
+    def test_get(self):
+        session = self.session()
+        with StubDictionaryServer() as server:
+            for _ in range(3):
+                response = session.get(server.endpoint + 'text=test')
+                self.assertEqual(response.json()['def'][0]['text'], 'test')
+        self.assertEqual(server.requests, ['test'] * 3)
+        self.assertEqual(session.stats()['calls'], 3)
+        self.assertEqual(len(session.latencies), 3)
+
+    def test_retry(self):
+        session = self.session()
+        with StubDictionaryServer(failures=2) as server:
+            response = session.get(server.endpoint + 'text=test')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(session.calls, 3)
+        self.assertEqual(session.failures, 2)
+
+    def test_retry_budget(self):
+        budget = httpclient.RetryBudget(ratio=0, max_tokens=1)
+        session = self.session(retries=5, budget=budget)
+        with StubDictionaryServer(failures=5) as server:
+            response = session.get(server.endpoint + 'text=test')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(session.calls, 2)
+
+    def test_backoffs(self):
+        budget = httpclient.RetryBudget(ratio=0, max_tokens=2)
+        session = self.session(retries=3, backoff=1, budget=budget)
+        delays = list(session.backoffs())
+        # the budget runs out before the retries do
+        self.assertEqual(len(delays), 2)
+        self.assertLessEqual(delays[1], 4)
+        self.assertEqual(list(session.backoffs()), [])
+
+    def test_timeout(self):
+        session = self.session(read_timeout=0.05, retries=1)
+        with StubDictionaryServer(latency=0.2) as server:
+            with self.assertRaises(httpclient.requests.Timeout):
+                session.get(server.endpoint + 'text=test')
+        self.assertEqual(session.failures, 2)
+
+
+class TestCircuitBreaker(TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.transitions = []
+        self.breaker = breaker.CircuitBreaker(
+            failure_ratio=0.5, slow_call=1, window=4, min_calls=4,
+            reset_timeout=10, half_open_calls=2,
+            failed=lambda result: result == 'error',
+            on_transition=lambda *states: self.transitions.append(states),
+            clock=lambda: self.now)
+
+    def test_trips_on_failures(self):
+        for result in ('ok', 'error', 'ok'):
+            self.breaker.call(lambda: result)
+        self.assertEqual(self.breaker.state, breaker.CLOSED)
+        with self.assertRaises(ValueError):
+            self.breaker.call(MagicMock(side_effect=ValueError))
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+        self.assertEqual(self.breaker.stats()['state'], 2)
+
+        func = MagicMock()
+        with self.assertRaises(exceptions.CircuitOpen):
+            self.breaker.call(func)
+        self.assertFalse(func.called)
+        self.assertEqual(self.breaker.stats()['rejected'], 1)
+
+    def test_trips_on_latency(self):
+        def slow():
+            self.now += 2
+        for _ in range(2):
+            self.breaker.call(lambda: 'ok')
+            self.breaker.call(slow)
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+
+    def test_half_open(self):
+        for _ in range(4):
+            self.breaker.call(lambda: 'error')
+        self.now += 10
+        self.breaker.allow()
+        self.assertEqual(self.breaker.state, breaker.HALF_OPEN)
+        self.assertEqual(self.breaker.stats()['state'], 1)
+        self.breaker.allow()
+        # no more probes than half_open_calls at once
+        with self.assertRaises(exceptions.CircuitOpen):
+            self.breaker.allow()
+        self.breaker.record(0, failed=False)
+        self.breaker.record(0, failed=True)
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+
+        self.now += 10
+        for _ in range(2):
+            self.breaker.call(lambda: 'ok')
+        self.assertEqual(self.breaker.state, breaker.CLOSED)
+        self.assertEqual(self.transitions, [
+            ('closed', 'open'), ('open', 'half_open'), ('half_open', 'open'),
+            ('open', 'half_open'), ('half_open', 'closed')])
+
+    @db.atomic()
+    def test_translate_fails_fast(self):
+        with test_database(db, (Chat, User, Request, Message, FirstRequest,
+                                 NegativeResult, Statistic, UserStatistic)):
+            cache.misses.clear()
+            user = User.create(tid=1, name='name')
+            chat = Chat.create(chat_id=1)
+            message = Message.create(chat=chat, user=user, message_id=1, time=1)
+            reply = MagicMock()
+            with patch('yadict.session') as session:
+                with patch('yadict.circuit', self.breaker):
+                    for _ in range(4):
+                        self.breaker.record(0, failed=True)
+                    translate('word', user, chat, message, MagicMock(), reply)
+            self.assertFalse(session.get.called)
+            reply.assert_called_once_with(
+                MessageTemplate.DICTIONARY_UNAVAILABLE)
+
+
+class TestStaleWhileRevalidate(TestCase):
+
+    def setUp(self):
+        cache.answers.clear()
+        # refreshes run inline, so the test sees them done
+        self.refresh_pool = MagicMock()
+        self.refresh_pool.submit.side_effect = \
+            lambda func, *args: func(*args)
+
+    @db.atomic()
+    @patch('config.Config.STALE_AFTER', 60)
+    @patch('yadict.fetch_content')
+    def test_refresh(self, fetch_content):
+        with test_database(db, (Request,)):
+            fetch_content.return_value = json.dumps(
+                {'def': [dummy_definition('test')]})
+            Request.create(content='test', raw='{"def": []}', answer='old',
+                           renderer=Translate.VERSION, fetched=int(time.time()))
+            request = Request.get(Request.content == 'test')
+            with patch('yadict.refresh_pool', self.refresh_pool):
+                self.assertEqual(yadict.load_content_from_db(request), 'old')
+                self.assertFalse(fetch_content.called)
+
+                Request.update(fetched=0).execute()
+                cache.answers.clear()
+                request = Request.get(Request.content == 'test')
+                # the stale answer is served, the refresh stored for next time
+                self.assertEqual(yadict.load_content_from_db(request), 'old')
+                fetch_content.assert_called_once_with('test')
+                request = Request.get(Request.content == 'test')
+                self.assertEqual(
+                    yadict.load_content_from_db(request),
+                    yadict.format_dict_message([dummy_definition('test')]))
+                self.assertGreater(request.fetched, 0)
+
+                # a stale row read before its refresh doesn't overwrite it
+                cache.answers.clear()
+                stale = Request.get(Request.content == 'test')
+                stale.answer, stale.fetched = 'old', 0
+                with patch('yadict.revalidate'):
+                    self.assertEqual(yadict.load_content_from_db(stale), 'old')
+                self.assertIsNone(cache.answers.get('test'))
+                Request.refresh('test', raw='{}', answer='new',
+                                renderer=Translate.VERSION)
+                self.assertEqual(yadict.load_content_from_db(stale), 'new')
+
+                # nothing is refreshed while the dictionary is unavailable
+                Request.update(fetched=0).execute()
+                request = Request.get(Request.content == 'test')
+                with patch('yadict.circuit.state', breaker.OPEN):
+                    self.assertFalse(yadict.revalidate(request))
+                fetch_content.side_effect = exceptions.CircuitOpen
+                self.assertTrue(yadict.revalidate(request))
+                self.assertEqual(yadict._refreshing, set())
+
+
+class TestSingleFlight(TestCase):
+
+    def test_concurrent_calls_share_result(self):
+        flights = singleflight.SingleFlight()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def fetch(key):
+            calls.append(key)
+            release.wait()
+            return key.upper()
+
+        def worker():
+            results.append(flights.do('word', fetch, 'word'))
+
+        threads = [threading.Thread(target=worker) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while flights.shared < 4:
+            release.wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(calls, ['word'])
+        self.assertEqual(results, ['WORD'] * 5)
+        self.assertEqual(flights.in_flight(), 0)
+
+        # finished calls are not remembered
+        self.assertEqual(flights.do('word', fetch, 'word'), 'WORD')
+        self.assertEqual(len(calls), 2)
+
+    def test_error_propagates(self):
+        flights = singleflight.SingleFlight()
+
+        def fail():
+            raise ValueError
+
+        with self.assertRaises(ValueError):
+            flights.do('word', fail)
+        self.assertEqual(flights.in_flight(), 0)
+
+
+class TestCallbackStore(TestCase):
+
+    def test_memory_store(self):
+        now = [0]
+        store = callbacks.MemoryCallbackStore(
+            max_entries=2, ttl=10, sweep_interval=1, clock=lambda: now[0])
+        first = store.save('first')
+        second = store.save('second')
+        self.assertEqual(store.pop(first), 'first')
+        self.assertIsNone(store.pop(first))
+
+        third = store.save('third')
+        fourth = store.save('fourth')
+        # the oldest entry is dropped on overflow
+        self.assertIsNone(store.pop(second))
+        self.assertEqual(len(store), 2)
+
+        now[0] = 10
+        self.assertIsNone(store.pop(third))
+        self.assertEqual(store.sweep(), 1)
+        self.assertEqual(len(store), 0)
+        self.assertIsNone(store.pop(fourth))
+
+    @db.atomic()
+    def test_database_store(self):
+        with test_database(db, (CallbackEntity,)):
+            store = callbacks.DatabaseCallbackStore(
+                max_entries=2, sweep_interval=1)
+            indexes = [store.save(str(i)) for i in range(4)]
+            self.assertEqual(store.pop(indexes[0]), '0')
+            self.assertIsNone(store.pop(indexes[0]))
+            self.assertEqual(store.sweep(), 1)
+            self.assertIsNone(store.pop(indexes[1]))
+            self.assertEqual(store.pop(indexes[3]), '3')
+
+
+class TestContext(TestCase):
+
+    @db.atomic()
+    def test_resolve_identities(self):
+        with test_database(db, (User, Chat)):
+            cache.users.clear()
+            cache.chats.clear()
+            user = User.resolve(tid=1, name='name')
+            # created rows are cached only after they are looked up again
+            self.assertIsNone(cache.users.get(1))
+            self.assertEqual(User.resolve(tid=1, name='name').id, user.id)
+            self.assertEqual(cache.users.get(1), user.id)
+            self.assertEqual(User.resolve(tid=1, name='renamed').id, user.id)
+            self.assertEqual(len(User.select()), 1)
+
+            chat = Chat.resolve(chat_id=1)
+            Chat.resolve(chat_id=1)
+            self.assertEqual(cache.chats.get(1), chat.id)
+            self.assertEqual(Chat.resolve(chat_id=1).id, chat.id)
+            self.assertEqual(len(Chat.select()), 1)
+
+    @db.atomic()
+    def test_contextify(self):
+        with test_database(db, (User, Chat, Message)):
+            cache.users.clear()
+            cache.chats.clear()
+            update = MagicMock()
+            update.callback_query = None
+            update.message.from_user.id = 1
+            update.message.from_user.first_name = 'name'
+            update.message.chat_id = 2
+            update.message.message_id = 3
+            update.message.to_dict.return_value = {'date': 4}
+
+            handler = contextify(lambda bot, update, **kwargs: kwargs)
+            context = handler(None, update)
+            self.assertEqual(context['user'].tid, 1)
+            self.assertEqual(context['chat'].chat_id, 2)
+            self.assertEqual(context['message'].message_id, 3)
+            self.assertEqual(context['message'].time, 4)
+            self.assertEqual(context['message'].user.id, context['user'].id)
+
+
+class TestWriteQueue(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.file_db = SqliteDatabase(
+            os.path.join(self.tmpdir.name, 'test.db'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_stop_without_writes(self):
+        write_queue = writer.WriteQueue(
+            self.file_db, max_batch=10, max_latency=1)
+        with patch('threading.excepthook') as excepthook:
+            write_queue.start()
+            write_queue.stop()
+        self.assertFalse(excepthook.called)
+
+    def test_inline(self):
+        with test_database(db, (Chat,)):
+            write_queue = writer.WriteQueue(db, max_batch=10, max_latency=1)
+            future = write_queue.submit(Chat.create, chat_id=1)
+            self.assertTrue(future.done())
+            self.assertEqual(future.result().chat_id, 1)
+            with self.assertRaises(ValueError):
+                write_queue.submit(int, 'x')
+
+    def test_group_commit(self):
+        with test_database(self.file_db, (Chat,)):
+            write_queue = writer.WriteQueue(
+                self.file_db, max_batch=10, max_latency=0.5)
+            write_queue.start()
+            futures = [write_queue.submit(Chat.create, chat_id=i)
+                       for i in range(5)]
+            failed = write_queue.submit(int, 'x')
+            futures.append(write_queue.submit(Chat.create, chat_id=5))
+            write_queue.stop()
+
+            self.assertEqual(
+                [future.result().chat_id for future in futures], list(range(6)))
+            self.assertIsInstance(failed.exception(), ValueError)
+            self.assertEqual(write_queue.batches, 1)
+            self.assertEqual(write_queue.writes, 7)
+            self.assertEqual(len(Chat.select()), 6)
+
+
+class TestCounters(TestCase):
+
+    def test_write_behind(self):
+        flushed = []
+        aggregator = counters.CounterAggregator(
+            apply=flushed.append, flush_interval=60, max_pending=5)
+
+        # not started yet, increments are applied right away
+        aggregator.bump(1)
+        self.assertEqual(flushed, [{1: 1}])
+
+        aggregator.start()
+        for key in (1, 2, 1, 1):
+            aggregator.bump(key)
+        self.assertEqual(len(flushed), 1)
+        self.assertEqual(aggregator.pending(1), 3)
+        aggregator.bump(2)
+        self.assertEqual(flushed[1], {1: 3, 2: 2})
+
+        aggregator.bump(3)
+        aggregator.stop()
+        self.assertEqual(flushed[2], {3: 1})
+        self.assertEqual(aggregator.flushes, 3)
+
+    def test_failed_flush(self):
+        flushed = []
+        failures = [ValueError('locked')]
+
+        def apply(increments):
+            if failures:
+                raise failures.pop()
+            flushed.append(increments)
+
+        aggregator = counters.CounterAggregator(
+            apply=apply, flush_interval=60, max_pending=100)
+        aggregator.start()
+        aggregator.bump(1, 2)
+        self.assertEqual(aggregator.flush(), 0)
+        self.assertEqual(aggregator.pending(1), 2)
+        aggregator.bump(1)
+        aggregator.stop()
+        self.assertEqual(flushed, [{1: 3}])
+
+        future = Future()
+        aggregator = counters.CounterAggregator(
+            apply=lambda increments: future, flush_interval=60, max_pending=100)
+        aggregator.start()
+        aggregator.bump(2)
+        aggregator.flush()
+        future.set_exception(ValueError('locked'))
+        self.assertEqual(aggregator.pending(2), 1)
+        aggregator.stop()
+
+    @db.atomic()
+    def test_add_counters(self):
+        with test_database(db, (Request,)):
+            first = Request.create(content='first')
+            second = Request.create(content='second')
+            Request.add_counters({first.id: 3, second.id: 1})
+            self.assertEqual(Request.get(Request.id == first.id).counter, 4)
+            self.assertEqual(Request.get(Request.id == second.id).counter, 2)
+
+
+class TestWorkers(TestCase):
+
+    def test_same_key_is_ordered(self):
+        executor = workers.ShardedExecutor(workers=4)
+        executor.start()
+        seen = {key: [] for key in range(8)}
+        for number in range(50):
+            for key in seen:
+                executor.submit(key, seen[key].append, number)
+        executor.stop()
+        for key in seen:
+            self.assertEqual(seen[key], list(range(50)))
+        self.assertEqual(executor.stats()['processed'], 400)
+        self.assertEqual(executor.stats()['depth'], 0)
+
+    def test_keys_run_in_parallel(self):
+        executor = workers.ShardedExecutor(workers=2)
+        executor.start()
+        blocked = threading.Event()
+        done = threading.Event()
+        # keys 0 and 1 land on different workers
+        executor.submit(0, blocked.wait, 5)
+        executor.submit(1, done.set)
+        self.assertTrue(done.wait(5))
+        blocked.set()
+        executor.stop()
+
+    def test_sharded_runs_inline_when_stopped(self):
+        executor = workers.ShardedExecutor(workers=2)
+        callback = MagicMock(return_value='result')
+        update = MagicMock(callback_query=None)
+        update.message.chat_id = 42
+        handler = workers.sharded(executor)(callback)
+        self.assertEqual(handler('bot', update, args=['word']), 'result')
+
+        executor.start()
+        self.assertIsNone(handler('bot', update, args=['word']))
+        executor.stop()
+        self.assertEqual(callback.call_count, 2)
+        callback.assert_called_with('bot', update, args=['word'])
+
+    @patch('config.Config.SPELLING_FALLBACK', False)
+    def test_parallel_handlers(self):
+        cache.users.clear()
+        cache.chats.clear()
+        cache.answers.clear()
+        cache.misses.clear()
+        # worker threads need a database shared between connections
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        database = SqliteDatabase(
+            os.path.join(tmpdir.name, 'test.db'),
+            pragmas=list(config.Config.SQLITE_PRAGMAS.items()))
+        write_queue = writer.WriteQueue(
+            database, max_batch=100, max_latency=0.01)
+        executor = workers.ShardedExecutor(workers=4)
+        handler = workers.sharded(executor)(translate_command)
+        bots = []
+        with test_database(database, (Chat, User, Request, Message,
+                                      FirstRequest, NegativeResult, Statistic,
+                                      UserStatistic)), \
+                StubDictionaryServer(latency=0.05) as server, \
+                patch('yadict.ENDPOINT', server.endpoint), \
+                patch('yappi.db', database), \
+                patch('yappi.write_queue', write_queue), \
+                patch('yadict.write_queue', write_queue), \
+                patch('models.write_queue', write_queue), \
+                patch('workers.logging') as logged:
+            write_queue.start()
+            executor.start()
+            for chat_id in range(8):
+                update = MagicMock(callback_query=None)
+                update.message.chat_id = chat_id
+                update.message.from_user.id = chat_id
+                update.message.from_user.first_name = 'name'
+                update.message.message_id = 1
+                update.message.text = '/tr word'
+                update.message.to_dict.return_value = {'date': 1}
+                bot = MagicMock()
+                bot.send_message.return_value.message_id = 2
+                bots.append(bot)
+                handler(bot, update, args=['word'])
+            executor.stop()
+            write_queue.stop()
+            # handlers sharing a transaction context fail on its savepoints
+            self.assertFalse(logged.exception.called)
+            self.assertEqual(FirstRequest.select().count(), 8)
+            self.assertEqual(Request.select().count(), 1)
+        answer = yadict.format_dict_message([dummy_definition('word')])
+        for bot in bots:
+            self.assertEqual(
+                bot.send_message.call_args[0][1],
+                Translate.HEAD.format(caption='word', answer=answer))
+
+
+class TestAsyncPipeline(TestCase):
+
+    def setUp(self):
+        # pipeline threads need a database shared between connections
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db = SqliteDatabase(os.path.join(self.tmpdir.name, 'test.db'))
+        self.pipeline = aio.Pipeline(db_threads=2, concurrency=10)
+        self.pipeline.start()
+        cache.answers.clear()
+        cache.misses.clear()
+        spelling.index.reset()
+
+    def tearDown(self):
+        self.pipeline.stop()
+        if not self.db.is_closed():
+            self.db.close()
+        self.tmpdir.cleanup()
+
+    @patch('config.Config.SPELLING_FALLBACK', False)
+    def test_translate(self):
+        with test_database(self.db, (Chat, User, Request, Message, FirstRequest,
+                                      NegativeResult, Statistic, UserStatistic)):
+            user = User.create(tid=1, name='name')
+            chat = Chat.create(chat_id=1)
+            message = Message.create(chat=chat, user=user, message_id=1, time=1)
+            reply = MagicMock()
+            reply.return_value = delivered(2)
+            bot = MagicMock()
+            with StubDictionaryServer(missing=['nothing']) as server, \
+                    patch('yadict.ENDPOINT', server.endpoint), \
+                    patch('aio.pipeline', self.pipeline), \
+                    patch('yadict.load_content_from_api') as blocking:
+                translate('Word', user, chat, message, bot, reply)
+                translate('nothing', user, chat, message, bot, reply)
+                translate('word', user, chat, message, bot, reply)
+
+            answer = yadict.format_dict_message([dummy_definition('word')])
+            self.assertEqual(reply.call_args_list, [
+                call(Translate.HEAD.format(caption='word', answer=answer),
+                     success=True, request='word'),
+                call(MessageTemplate.CANT_FIND.format('nothing')),
+                call(MessageTemplate.ALREADY_REQUESTED,
+                     success=True, request='word'),
+            ])
+            self.assertEqual(server.requests, ['word', 'nothing'])
+            self.assertFalse(blocking.called)
+            self.assertEqual(Request.get_request('word').answer, answer)
+            self.assertEqual(FirstRequest.select().count(), 1)
+            bot.send_message.assert_called_with(
+                1, Emoji.WHITE_UP_POINTING_INDEX, reply_to_message_id=2)
+
+    def test_blocking_fetches_off_db_threads(self):
+        with patch('aio.aiohttp', None):
+            pipeline = aio.Pipeline(db_threads=1, concurrency=10)
+            pipeline.start()
+        self.addCleanup(pipeline.stop)
+        threads = set()
+
+        def request(content):
+            threads.add(threading.current_thread().name)
+            time.sleep(0.1)
+            return MagicMock(text=content)
+
+        with patch('yadict.dicservice_request', side_effect=request):
+            start = time.monotonic()
+            results = pipeline.run(pipeline.fetch_many(
+                ['word{}'.format(number) for number in range(5)]))
+        self.assertEqual(results[0], 'word0')
+        # all at once, not one by one on the single db thread
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertTrue(all(name.startswith('aio_http') for name in threads))
+
+    def test_concurrent_lookups_share_fetch(self):
+        with test_database(self.db, (Request, Statistic)):
+            with StubDictionaryServer(latency=0.1) as server:
+                with patch('yadict.ENDPOINT', server.endpoint):
+                    async def lookups():
+                        return await asyncio.gather(*[
+                            self.pipeline.load_content_from_api(word)
+                            for word in ('word', 'word', 'other', 'word')])
+                    results = self.pipeline.run(lookups())
+            self.assertEqual(sorted(server.requests), ['other', 'word'])
+            self.assertEqual(self.pipeline.shared, 2)
+            self.assertEqual(results[0], results[1])
+            self.assertEqual(Request.select().count(), 2)
+
+
+class TestMetrics(TestCase):
+
+    def test_histogram(self):
+        histogram = metrics.Histogram(buckets=(0.1, 0.2, 0.4))
+        for value in (0.05, 0.15, 0.15, 0.3, 1.0):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [1, 2, 1, 1])
+        self.assertAlmostEqual(histogram.quantile(0.5), 0.175)
+        self.assertEqual(histogram.quantile(0.99), 0.4)
+        self.assertEqual(metrics.Histogram().quantile(0.5), 0.0)
+
+    def test_timed(self):
+        def lookup(word):
+            if not word:
+                raise ValueError
+            return word
+
+        disabled = metrics.Registry(enabled=False)
+        self.assertIs(disabled.timed('lookup')(lookup), lookup)
+
+        registry = metrics.Registry(enabled=True)
+        timed_lookup = registry.timed('lookup')(lookup)
+        self.assertEqual(timed_lookup('word'), 'word')
+        with self.assertRaises(ValueError):
+            timed_lookup('')
+        self.assertEqual(registry.stages['lookup'].count, 2)
+        self.assertEqual(registry.counters['lookup_errors'].value, 1)
+        [(name, count, (p50, p99))] = registry.summary()
+        self.assertEqual((name, count), ('lookup', 2))
+        self.assertLessEqual(p50, p99)
+
+    def test_export(self):
+        registry = metrics.Registry(enabled=True)
+        registry.stage('render').observe(0.003)
+        registry.counter('breaker_opened').inc()
+        registry.collector('cache', lambda: {'hits': 3, 'name': 'answers'})
+        text = registry.render()
+        self.assertIn(
+            'yappi_stage_seconds_bucket{stage="render",le="0.005"} 1', text)
+        self.assertIn(
+            'yappi_stage_seconds_bucket{stage="render",le="+Inf"} 1', text)
+        self.assertIn('yappi_stage_seconds_count{stage="render"} 1', text)
+        self.assertIn('yappi_breaker_opened_total 1', text)
+        self.assertIn('yappi_cache_hits 3', text)
+        self.assertNotIn('answers', text)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'yappi.prom')
+            registry.write_textfile(path)
+            with open(path) as textfile:
+                self.assertEqual(textfile.read(), text)
+
+        server = metrics.serve(registry, port=0)
+        try:
+            response = httpclient.requests.get(
+                'http://127.0.0.1:{}/metrics'.format(server.server_address[1]))
+            self.assertEqual(response.text, text)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TestWebhook(TestCase):
+
+    UPDATE = {
+        'update_id': 1,
+        'message': {
+            'message_id': 2,
+            'from': {'id': 3, 'first_name': 'name'},
+            'chat': {'id': 3, 'type': 'private'},
+            'date': 1500000000,
+            'text': 'word',
+        },
+    }
+
+    def post(self, server, path, data):
+        return requests.post(
+            'http://127.0.0.1:{}{}'.format(server.port, path), data=data)
+
+    def test_post(self):
+        updates = queue.Queue(maxsize=1)
+        server = webhook.serve(MagicMock(), updates, '/secret', port=0)
+        try:
+            body = json.dumps(self.UPDATE)
+            self.assertEqual(self.post(server, '/other', body).status_code, 404)
+            self.assertEqual(
+                self.post(server, '/s\u00e9cret', body).status_code, 404)
+            self.assertEqual(
+                self.post(server, '/secret', 'not json').status_code, 400)
+            self.assertEqual(self.post(server, '/secret', body).status_code, 200)
+            # backpressure once the queue is full
+            response = self.post(server, '/secret', body)
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+        finally:
+            server.shutdown()
+        self.assertEqual(server.socket.fileno(), -1)
+        update = updates.get_nowait()
+        self.assertEqual(update.update_id, 1)
+        self.assertEqual(update.message.text, 'word')
+        self.assertEqual(update.message.from_user.id, 3)
+        self.assertEqual(server.stats()['depth'], 0)
+
+    @patch('config.Config.WORKERS', 4)
+    @patch('config.Config.WEBHOOK_QUEUE_SIZE', 1000)
+    def test_worker_queues_bounded(self):
+        with patch('config.Config.WORKER_QUEUE_SIZE', 0):
+            with patch('config.Config.UPDATE_MODE', 'polling'):
+                self.assertEqual(worker_queue_size(), 0)
+            # unbounded worker queues would drain the webhook queue
+            with patch('config.Config.UPDATE_MODE', 'webhook'):
+                self.assertEqual(worker_queue_size(), 250)
+        with patch('config.Config.WORKER_QUEUE_SIZE', 10), \
+                patch('config.Config.UPDATE_MODE', 'webhook'):
+            self.assertEqual(worker_queue_size(), 10)
+
+    def test_dispatch(self):
+        received = queue.Queue()
+        updater = Updater(bot=MagicMock())
+        updater.dispatcher.add_handler(MessageHandler(
+            Filters.text, lambda bot, update: received.put(update)))
+        server = webhook.start(
+            updater, '/secret', port=0, url='https://example.com/', queue_size=2)
+        try:
+            updater.bot.setWebhook.assert_called_once_with(
+                webhook_url='https://example.com/secret')
+            response = self.post(server, '/secret', json.dumps(self.UPDATE))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(received.get(timeout=5).message.text, 'word')
+        finally:
+            updater.stop()
+        self.assertEqual(server.socket.fileno(), -1)
+
+
+class TestOutbox(TestCase):
+
+    def setUp(self):
+        self.transport = FakeTransport()
+
+    def outbox(self, **kwargs):
+        params = dict(rate=1000, burst=1000, chat_rate=1000, chat_burst=1000)
+        params.update(kwargs)
+        scheduler = outbox.Outbox(**params)
+        scheduler.start()
+        self.addCleanup(scheduler.stop)
+        return scheduler
+
+    def test_token_bucket(self):
+        now = [0.0]
+        bucket = outbox.TokenBucket(rate=2, capacity=2, clock=lambda: now[0])
+        for _ in range(2):
+            self.assertEqual(bucket.delay(), 0)
+            bucket.consume()
+        self.assertEqual(bucket.delay(), 0.5)
+        now[0] = 0.25
+        self.assertEqual(bucket.delay(), 0.25)
+        now[0] = 10
+        self.assertTrue(bucket.full)
+
+    def test_inline(self):
+        scheduler = outbox.Outbox(
+            rate=1, burst=1, chat_rate=1, chat_burst=1)
+        for _ in range(3):
+            scheduler.send(self.transport, 1, 'text')
+        message = scheduler.edit(self.transport, 1, 7, text='edit').result()
+        self.assertEqual(message.message_id, 7)
+        self.assertEqual(len(self.transport.calls), 4)
+
+    def test_send_while_stopping(self):
+        scheduler = self.outbox()
+        with scheduler._condition:
+            scheduler._stopping = True
+        # the final drain may be over, a late message goes out inline
+        future = scheduler.send(self.transport, 1, 'late')
+        self.assertTrue(future.done())
+        self.assertEqual(len(self.transport.calls), 1)
+
+    def test_edits_first_and_coalesced(self):
+        scheduler = self.outbox()
+        self.transport.gate.clear()
+        first = scheduler.send(self.transport, 1, 'first')
+        while scheduler.stats()['sends']:
+            time.sleep(0.001)
+        second = scheduler.send(self.transport, 1, 'second')
+        edits = [scheduler.edit(self.transport, 1, 5, text=text)
+                 for text in ('one', 'two', 'three')]
+        other = scheduler.edit(self.transport, 2, 5, text='other')
+        self.transport.gate.set()
+
+        self.assertEqual(second.result(timeout=5).text, 'second')
+        self.assertEqual(
+            [(method, chat_id, text)
+             for method, chat_id, text, _ in self.transport.calls],
+            [('send', 1, 'first'), ('edit', 1, 'three'),
+             ('edit', 2, 'other'), ('send', 1, 'second')])
+        self.assertEqual(first.result().text, 'first')
+        self.assertEqual(other.result().chat_id, 2)
+        for edit in edits:
+            self.assertEqual(edit.result().text, 'three')
+        self.assertEqual(scheduler.stats()['coalesced'], 2)
+
+    def test_rate_limits(self):
+        scheduler = self.outbox(chat_rate=20, chat_burst=1)
+        busy = [scheduler.send(self.transport, 1, str(n)) for n in range(3)]
+        idle = scheduler.send(self.transport, 2, 'idle')
+        for future in busy + [idle]:
+            future.result(timeout=5)
+        times = {(chat_id, text): sent
+                 for _, chat_id, text, sent in self.transport.calls}
+        self.assertGreaterEqual(times[1, '2'] - times[1, '0'], 0.09)
+        # a busy chat doesn't hold back the others
+        self.assertLess(times[2, 'idle'], times[1, '1'])
+
+        scheduler = self.outbox(rate=20, burst=1)
+        start = time.monotonic()
+        for future in [scheduler.send(self.transport, chat_id, 'global')
+                       for chat_id in range(3)]:
+            future.result(timeout=5)
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    def test_retry_after(self):
+        scheduler = self.outbox()
+        waited = scheduler.waiting.count
+        self.transport.failures = [RetryAfter(0.05)]
+        start = time.monotonic()
+        self.assertEqual(
+            scheduler.send(self.transport, 1, 'text').result(timeout=5).text,
+            'text')
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        self.transport.failures = [ValueError('bad')]
+        with self.assertRaises(ValueError):
+            scheduler.send(self.transport, 1, 'text').result(timeout=5)
+        self.assertEqual(scheduler.stats()['retries'], 1)
+        self.assertEqual(scheduler.waiting.count - waited, 3)
+
+
+class TestOfflineIndex(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'dictionary.idx')
+        words = ['time', 'Apple', 'zebra', 'ёж', 'time']
+        lines = [json.dumps({'head': {}, 'def': [{'text': word, 'n': i}]})
+                 for i, word in enumerate(words)]
+        lines.append(json.dumps({'head': {}, 'def': []}))
+        self.entries = offline.build_index(iter(lines), self.path)
+
+    def tearDown(self):
+        offline._index = None
+        self.tmpdir.cleanup()
+
+    def test_lookup(self):
+        self.assertEqual(self.entries, 4)
+        index = offline.OfflineIndex(self.path)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(json.loads(index.get('apple'))['def'][0]['n'], 1)
+        self.assertEqual(json.loads(index.get('ёж'))['def'][0]['n'], 3)
+        # the last answer wins for duplicates
+        self.assertEqual(json.loads(index.get('time'))['def'][0]['n'], 4)
+        self.assertIsNone(index.get('tim'))
+        self.assertIsNone(index.get('zzz'))
+        index.close()
+
+    @patch('yadict.dicservice_request')
+    def test_fetch_content(self, dicservice_request):
+        dicservice_request.return_value.text = '{"def": []}'
+        with patch('config.Config.OFFLINE_INDEX', self.path):
+            self.assertIn('zebra', yadict.fetch_content('zebra'))
+            self.assertFalse(dicservice_request.called)
+            self.assertEqual(yadict.fetch_content('unknown'), '{"def": []}')
+            self.assertTrue(dicservice_request.called)
+
+
+class TestSpelling(TestCase):
+
+    def setUp(self):
+        cache.answers.clear()
+        cache.misses.clear()
+        cache.speller_misses.clear()
+        cache.first_requests.clear()
+        spelling.index.reset()
+
+    def test_edits(self):
+        candidates = set(spelling.edits('ab', 'abc'))
+        for edit in ('b', 'a', 'ba', 'cb', 'ac', 'cab', 'acb', 'abc'):
+            self.assertIn(edit, candidates)
+
+    def test_suggest(self):
+        index = spelling.SpellingIndex(max_distance=2)
+        index.loaded = True
+        for word, weight in (('word', 1), ('ward', 5), ('cord', 3),
+                             ('rhythm', 0), ('translation', 0)):
+            index.add(word, weight)
+        self.assertIsNone(index.suggest('word'))
+        self.assertEqual(index.suggest('wrod'), 'word')
+        # the most requested of equally close words wins
+        self.assertEqual(index.suggest('xord'), 'cord')
+        self.assertEqual(index.suggest('rythm'), 'rhythm')
+        # two typos need a longer word
+        self.assertIsNone(index.suggest('owrdd'))
+        self.assertEqual(index.suggest('trnaslatoin'), 'translation')
+        self.assertIsNone(index.suggest('nothing'))
+
+    @db.atomic()
+    @patch('yadict.pyaspeller')
+    def test_check_spelling(self, pyaspeller):
+        with test_database(db, (Request,)):
+            Request.create(content='word', raw='{}')
+            # the index knows nothing until it is loaded
+            self.assertNotIn('word', spelling.index)
+            self.assertIsNone(spelling.index.suggest('wrod'))
+            spelling.index.load()
+            self.assertEqual(yadict.check_spelling('word'), ('word', None))
+            correction, spellcheck = yadict.check_spelling('wrod')
+            self.assertEqual(correction, 'word')
+            self.assertEqual(
+                yadict.answer_spellcheck(spellcheck, 'answer'),
+                '    _Your request was corrected!_\nanswer')
+            self.assertFalse(pyaspeller.Word.called)
+
+            with patch('config.Config.SPELLING_FALLBACK', True):
+                pyaspeller.Word.return_value.spellsafe = 'nothing'
+                self.assertEqual(yadict.check_spelling('nothign')[0], 'nothing')
+                self.assertEqual(
+                    yadict.check_spelling('nothign', fallback=False),
+                    ('nothign', None))
+                # words the speller can't correct aren't sent again
+                pyaspeller.Word.return_value.spellsafe = None
+                self.assertEqual(yadict.check_spelling('xyz')[0], 'xyz')
+                self.assertEqual(yadict.check_spelling('xyz')[0], 'xyz')
+                self.assertTrue(cache.speller_misses.get('xyz'))
+                self.assertEqual(len(cache.misses), 0)
+            self.assertEqual(
+                yadict.check_spelling('nothign'), ('nothign', None))
+            self.assertEqual(pyaspeller.Word.call_count, 2)
+
+    @db.atomic()
+    @patch('config.Config.SPELLING_FALLBACK', True)
+    @patch('yadict.check_spelling', return_value=('nothing', None))
+    def test_known_miss_skips_speller(self, check_spelling):
+        with test_database(db, (Chat, User, Request, Message, FirstRequest,
+                                 NegativeResult, Statistic, UserStatistic)):
+            user = User.create(tid=1, name='name')
+            chat = Chat.create(chat_id=1)
+            message = Message.create(chat=chat, user=user, message_id=1, time=1)
+            reply = MagicMock()
+            with StubDictionaryServer(missing=['nothing']) as server:
+                with patch('yadict.ENDPOINT', server.endpoint):
+                    translate('nothing', user, chat, message, MagicMock(), reply)
+                    translate('nothing', user, chat, message, MagicMock(), reply)
+            self.assertEqual(server.requests, ['nothing'])
+            self.assertEqual(check_spelling.call_args_list, [
+                call('nothing', fallback=True),
+                call('nothing', fallback=False),
+            ])
+
+    @db.atomic()
+    @patch('config.Config.SPELLING_FALLBACK', False)
+    def test_translate_typo(self):
+        with test_database(db, (Chat, User, Request, Message, FirstRequest,
+                                 NegativeResult, Statistic, UserStatistic)):
+            user = User.create(tid=1, name='name')
+            chat = Chat.create(chat_id=1)
+            message = Message.create(chat=chat, user=user, message_id=1, time=1)
+            reply = MagicMock()
+            reply.return_value = delivered(2)
+            spelling.index.load()
+            with StubDictionaryServer(missing=['wrod']) as server:
+                with patch('yadict.ENDPOINT', server.endpoint):
+                    translate('word', user, chat, message, MagicMock(), reply)
+                    FirstRequest.delete().execute()
+                    translate('wrod', user, chat, message, MagicMock(), reply)
+            self.assertEqual(server.requests, ['word', 'wrod'])
+            answer = yadict.format_dict_message([dummy_definition('word')])
+            reply.assert_called_with(
+                '    _Your request was corrected!_\n' +
+                Translate.HEAD.format(caption='word', answer=answer),
+                success=True, request='word')
+            self.assertEqual(FirstRequest.select().count(), 1)
+
+
+class TestBatch(TestCase):
+
+    def setUp(self):
+        cache.answers.clear()
+        cache.misses.clear()
+        cache.first_requests.clear()
+
+    def test_split_terms(self):
+        self.assertEqual(
+            yadict.split_terms('Apple, pear;\n\napple\nice cream,``, !'),
+            ['apple', 'pear', 'ice cream'])
+        self.assertEqual(yadict.split_terms('word'), ['word'])
+
+    def test_split_message(self):
+        parts = ['a' * 4, 'b' * 4, 'c' * 4, 'd' * 12]
+        self.assertEqual(split_message(parts, limit=10), [
+            ('aaaa\nbbbb', [0, 1]),
+            ('cccc', [2]),
+            ('dddddddddd', [3]),
+            ('dd', []),
+        ])
+        # long answers are cut between lines, not inside them
+        answer = '*one*\n_two_\n*three*\n_four_'
+        self.assertEqual(split_message(['a' * 4, answer], limit=14), [
+            ('aaaa', [0]),
+            ('*one*\n_two_', [1]),
+            ('*three*\n_four_', []),
+        ])
+        self.assertEqual(cut_lines('ab\n' + 'c' * 5 + '\nd', 2),
+                         ['ab', 'cc', 'cc', 'c', 'd'])
+        # rendered answers end with a line break, no empty message for it
+        self.assertEqual(split_message(['x' * 60 + '\n', 'short'], 30), [
+            ('x' * 30, [0]),
+            ('x' * 30, []),
+            ('short', [1]),
+        ])
+
+    def test_batch_shares_fetch(self):
+        with StubDictionaryServer(latency=0.2) as server, \
+                patch('yadict.ENDPOINT', server.endpoint):
+            single = threading.Thread(
+                target=yadict.shared_fetch, args=('word',))
+            single.start()
+            time.sleep(0.05)
+            raws = yadict.fetch_many(['word', 'other'])
+            single.join()
+        self.assertEqual(sorted(server.requests), ['other', 'word'])
+        self.assertEqual(json.loads(raws[0])['def'][0]['text'], 'word')
+
+    @db.atomic()
+    def test_translate_batch(self):
+        with test_database(db, (Chat, User, Request, Message, FirstRequest,
+                                 NegativeResult, Statistic, UserStatistic)):
+            user = User.create(tid=1, name='name')
+            chat = Chat.create(chat_id=1)
+            message = Message.create(chat=chat, user=user, message_id=1, time=1)
+            reply = MagicMock()
+            reply.return_value = delivered(2)
+            Request.create(
+                content='known', raw=json.dumps(
+                    {'def': [dummy_definition('known')]}))
+            cache.misses.put('missed', True)
+
+            contents = ['word', 'known', 'nothing', 'missed', 'other']
+            with StubDictionaryServer(missing=['nothing']) as server:
+                with patch('yadict.ENDPOINT', server.endpoint):
+                    translate_batch(contents, user, chat, message, reply)
+
+            self.assertEqual(sorted(server.requests), ['nothing', 'other', 'word'])
+            text = reply.call_args[0][0]
+            self.assertEqual(reply.call_count, 1)
+            for content in ('word', 'known', 'other'):
+                answer = yadict.format_dict_message([dummy_definition(content)])
+                self.assertIn(
+                    Translate.HEAD.format(caption=content, answer=answer), text)
+            self.assertTrue(text.endswith(
+                MessageTemplate.CANT_FIND.format('nothing`, `missed')))
+            self.assertEqual(FirstRequest.select().count(), 3)
+            self.assertTrue(cache.misses.get('nothing'))
+
+            # translations that were already sent are not recorded twice
+            with patch('yadict.fetch_content') as fetch_content:
+                translate_batch(['word', 'known'], user, chat, message, reply)
+            self.assertFalse(fetch_content.called)
+            self.assertEqual(FirstRequest.select().count(), 3)
+
+
+    @db.atomic()
+    @patch('yappi.write_queue')
+    def test_first_request_saved_when_sent(self, write_queue):
+        # a running write queue, writing on the thread that submits
+        write_queue.running = True
+        write_queue.submit.side_effect = \
+            lambda func, *args, **kwargs: func(*args, **kwargs)
+        with test_database(db, (Chat, User, Request, Message, FirstRequest,
+                                 NegativeResult, Statistic, UserStatistic)):
+            user = User.create(tid=1, name='name')
+            chat = Chat.create(chat_id=1)
+            message = Message.create(chat=chat, user=user, message_id=1, time=1)
+            Request.create(
+                content='word', raw=json.dumps(
+                    {'def': [dummy_definition('word')]}))
+            sent = Future()
+            reply = MagicMock(return_value=sent)
+            # the handler doesn't wait for the reply to be delivered
+            translate('word', user, chat, message, MagicMock(), reply)
+            self.assertEqual(FirstRequest.select().count(), 0)
+            sent.set_result(MagicMock(message_id=2))
+            self.assertEqual(FirstRequest.get().reply_to, 2)
+
+            FirstRequest.delete().execute()
+            failed = Future()
+            reply.return_value = failed
+            translate_batch(['word'], user, chat, message, reply)
+            failed.set_exception(RetryAfter(1))
+            self.assertEqual(FirstRequest.select().count(), 0)
+
+    @db.atomic()
+    def test_first_request_saved_without_write_queue(self):
+        scheduler = outbox.Outbox(
+            rate=1000, burst=1000, chat_rate=1000, chat_burst=1000)
+        scheduler.start()
+        self.addCleanup(scheduler.stop)
+        transport = FakeTransport()
+        with test_database(db, (Chat, User, Request, Message, FirstRequest,
+                                 NegativeResult, Statistic, UserStatistic)):
+            user = User.create(tid=1, name='name')
+            chat = Chat.create(chat_id=1)
+            message = Message.create(chat=chat, user=user, message_id=1, time=1)
+            Request.create(
+                content='word', raw=json.dumps(
+                    {'def': [dummy_definition('word')]}))
+            translate('word', user, chat, message, MagicMock(),
+                      lambda text, **kwargs: scheduler.send(transport, 1, text))
+            # saved on this thread, the in-memory database isn't shared
+            self.assertEqual(FirstRequest.get().reply_to, 1)
+
+
 class TestTranslate(TestCase):
 
     @db.atomic()
@@ -115,7 +1626,8 @@ class TestTranslate(TestCase):
     @patch('yadict.format_dict_message')
     @patch('yadict.dicservice_request')
     def test_translate(self, dicservice_request, format_dict_message, load_content_from_db):
-        with test_database(db, (Chat, User, Request, Message, FirstRequest)):
+        with test_database(db, (Chat, User, Request, Message, FirstRequest,
+                                 Statistic, UserStatistic)):
             content = 'test'
             user = User.create(tid=1, name='name')
             chat = Chat.create(chat_id=1)
@@ -175,7 +1687,7 @@ class TestTranslate(TestCase):
             reply.assert_called_with(content)
             request_query = Request.get_request(content='test')
             self.assertEqual(len(Request.select()), 1)
-            self.assertEqual(request_query.raw, '{"def": "test"}')
+            self.assertEqual(request_query.load_raw(), '{"def": "test"}')
 
             # request and first request were created
             # so we need to remove first request
@@ -199,7 +1711,7 @@ class TestTranslate(TestCase):
             reply.assert_called_with(content)
             request_query = Request.get_request(content='test')
             self.assertEqual(len(Request.select()), 1)
-            self.assertEqual(request_query.raw, '{"def": "test"}')
+            self.assertEqual(request_query.load_raw(), '{"def": "test"}')
 
             def dummy_send_message(*args, **kwargs):
                 return kwargs['reply_to_message_id']
@@ -0,0 +1,66 @@
+"""
+This module pre-fills the answer cache with the most popular requests.
+"""
+
+import logging
+import threading
+import time
+
+from peewee import fn
+
+import cache
+import yadict
+
+from models import db, stream, Request
+from templates import Translate
+
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+def warm_up(limit):
+    start = time.monotonic()
+    # never evict what was just warmed
+    limit = min(limit, cache.answers.max_entries)
+    query = (Request
+             .select(Request.id, Request.content,
+                     Request.answer, Request.renderer, Request.counter)
+             .order_by(Request.counter.desc())
+             .limit(limit)
+             .naive())
+    warmed = lookups = 0
+    for request in stream(query):
+        if request.renderer == Translate.VERSION:
+            answer = request.answer
+        else:
+            answer = yadict.render_request(request)
+        cache.answers.put(request.content, answer)
+        warmed += 1
+        lookups += request.counter
+    total = Request.select(fn.SUM(Request.counter)).scalar() or 0
+    report = {
+        'entries': warmed,
+        'seconds': time.monotonic() - start,
+        'coverage': lookups / total if total else 0.0,
+    }
+    logging.info(
+        'cache warm-up: %(entries)d answers in %(seconds).2fs, '
+        'covering %(coverage).0f%% of lookups',
+        dict(report, coverage=report['coverage'] * 100))
+    return report
+
+
+def _warm_up(limit):
+    try:
+        warm_up(limit)
+    except Exception as err:
+        logging.exception(str(err))
+    finally:
+        db.close()
+
+
+def start(limit):
+    thread = threading.Thread(
+        target=_warm_up, args=(limit,), name='cache_warmup', daemon=True)
+    thread.start()
+    return thread
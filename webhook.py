@@ -0,0 +1,121 @@
+"""
+This module contains the webhook mode of the bot: an embedded HTTP server
+taking update POSTs from Telegram on a secret path and feeding them to the
+dispatcher through a bounded queue.
+
+While the queue is full updates are answered with 503, so Telegram keeps
+them and delivers them again later instead of the bot running out of
+memory.
+"""
+
+import hmac
+import json
+import logging
+import queue
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from telegram import Update
+
+import metrics
+
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+MAX_BODY = 1024 * 1024
+
+
+class WebhookServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, bot, update_queue, path):
+        super().__init__(address, WebhookHandler)
+        self.bot = bot
+        self.update_queue = update_queue
+        self.path = path
+        self.received = metrics.registry.counter('webhook_updates')
+        self.rejected = metrics.registry.counter('webhook_rejected')
+
+    def shutdown(self):
+        # the updater stops its httpd with shutdown() only
+        super().shutdown()
+        self.server_close()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def stats(self):
+        return {
+            'depth': self.update_queue.qsize(),
+            'received': self.received.value,
+            'rejected': self.rejected.value,
+        }
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        # in constant time, the path is the only secret of the webhook
+        if not hmac.compare_digest(self.path.encode('utf-8'),
+                                   self.server.path.encode('utf-8')):
+            self.send_error(404)
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY:
+            self.send_error(413)
+            return
+        try:
+            data = json.loads(self.rfile.read(length).decode('utf-8'))
+            update = Update.de_json(data, self.server.bot)
+        except (ValueError, TypeError, KeyError) as err:
+            logging.warning('bad webhook update: %s', err)
+            self.send_error(400)
+            return
+        try:
+            self.server.update_queue.put_nowait(update)
+        except queue.Full:
+            self.server.rejected.inc()
+            self.send_response(503)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.server.received.inc()
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(bot, update_queue, path, port, host='127.0.0.1'):
+    server = WebhookServer((host, port), bot, update_queue, path)
+    thread = threading.Thread(
+        target=server.serve_forever, name='webhook_http', daemon=True)
+    thread.start()
+    return server
+
+
+def start(updater, path, port, host='127.0.0.1', url=None, queue_size=1000):
+    """
+    Starts the dispatcher of ``updater`` on a queue of ``queue_size``
+    updates filled by the webhook server, and registers ``url`` + ``path``
+    with Telegram if ``url`` is given. ``updater.stop()`` stops both and
+    closes the server socket.
+    """
+    update_queue = queue.Queue(maxsize=queue_size)
+    updater.update_queue = updater.dispatcher.update_queue = update_queue
+    server = serve(updater.bot, update_queue, path, port, host)
+    # the updater shuts down its httpd and joins the threads it started
+    updater.httpd = server
+    updater.running = True
+    updater.job_queue.start()
+    updater._init_thread(updater.dispatcher.start, 'dispatcher')
+    if url:
+        updater.bot.setWebhook(webhook_url=url.rstrip('/') + path)
+    logging.info('webhook listening on %s:%d', host, server.port)
+    return server
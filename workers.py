@@ -0,0 +1,113 @@
+"""
+This module contains a worker pool that runs handlers of different chats
+in parallel while keeping updates of the same chat strictly ordered.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+from collections import deque
+from functools import wraps
+
+from models import db
+
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+_STOP = object()
+
+
+class ShardedExecutor(object):
+    """
+    Every key is bound to one of ``workers`` queues, each drained by a
+    single thread, so tasks with the same key run one after another in
+    submission order.
+
+    Each worker keeps its own peewee connection (connections are
+    thread-local) for its whole life and closes it on stop.
+    """
+
+    def __init__(self, workers, max_queue=0):
+        self.workers = workers
+        self.processed = 0
+        self.wait_times = deque(maxlen=1000)
+        self._queues = [queue.Queue(max_queue) for _ in range(workers)]
+        self._threads = []
+
+    @property
+    def running(self):
+        return bool(self._threads)
+
+    def submit(self, key, func, *args, **kwargs):
+        shard = self._queues[hash(key) % self.workers]
+        shard.put((time.monotonic(), func, args, kwargs))
+
+    def start(self):
+        if self.running:
+            return
+        for number, shard in enumerate(self._queues):
+            thread = threading.Thread(
+                target=self._work, args=(shard,),
+                name='handler_worker_{}'.format(number), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for shard in self._queues:
+            shard.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _work(self, shard):
+        while True:
+            item = shard.get()
+            if item is _STOP:
+                break
+            enqueued, func, args, kwargs = item
+            self.wait_times.append(time.monotonic() - enqueued)
+            try:
+                func(*args, **kwargs)
+            except Exception as err:
+                logging.exception(str(err))
+            self.processed += 1
+        if not db.is_closed():
+            db.close()
+
+    def depth(self):
+        return [shard.qsize() for shard in self._queues]
+
+    def stats(self):
+        depth = self.depth()
+        wait_times = list(self.wait_times)
+        return {
+            'depth': sum(depth),
+            'max_depth': max(depth) if depth else 0,
+            'processed': self.processed,
+            'wait_avg': sum(wait_times) / len(wait_times) if wait_times else 0.0,
+            'wait_max': max(wait_times) if wait_times else 0.0,
+        }
+
+
+def chat_key(update):
+    source = update.callback_query or update
+    if source.message is None:
+        return 0
+    return source.message.chat_id
+
+
+def sharded(executor):
+    """
+    Makes a dispatcher callback run on ``executor``, keyed by chat. While
+    the executor isn't running the callback is called directly.
+    """
+    def decorator(callback):
+        @wraps(callback)
+        def wrapper(bot, update, **kwargs):
+            if not executor.running:
+                return callback(bot, update, **kwargs)
+            executor.submit(chat_key(update), callback, bot, update, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,119 @@
+"""
+This module contains a single-writer queue that batches database writes
+into group commits.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+from concurrent.futures import Future
+
+
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+_STOP = object()
+
+
+class WriteQueue(object):
+    """
+    Write intents are callables executed by a dedicated writer thread.
+    Intents arriving within ``max_latency`` seconds of each other (up to
+    ``max_batch`` of them) share one transaction, so they cost a single
+    fsync. Each intent runs in its own savepoint, a failing intent doesn't
+    affect the rest of the batch.
+
+    Until the queue is started, intents run inline in the calling thread.
+    """
+
+    def __init__(self, database, max_batch, max_latency):
+        self.database = database
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.batches = 0
+        self.writes = 0
+        self._queue = queue.Queue()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        if not self.running:
+            future.set_result(func(*args, **kwargs))
+            return future
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def start(self):
+        if self.running:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name='db_writer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+        if not self.database.is_closed():
+            self.database.close()
+
+    def _commit(self, batch):
+        results = []
+        try:
+            with self.database.atomic():
+                for future, func, args, kwargs in batch:
+                    try:
+                        with self.database.atomic():
+                            results.append((future, func(*args, **kwargs), None))
+                    except Exception as err:
+                        logging.exception(str(err))
+                        results.append((future, None, err))
+        except Exception as err:
+            logging.exception(str(err))
+            for future, _, _, _ in batch:
+                future.set_exception(err)
+            return
+        self.batches += 1
+        self.writes += len(batch)
+        # futures resolve only once their writes are committed
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            'pending': self._queue.qsize(),
+            'batches': self.batches,
+            'writes': self.writes,
+        }
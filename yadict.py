@@ -4,13 +4,26 @@ This module provides API functionality for yandex lingvo services.
 
 import json
 import logging
+import re
 import requests
 import string
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 import pyaspeller
+import breaker
+import cache
 import config
+import exceptions
+import httpclient
+import metrics
+import offline
+import singleflight
+import spelling
 
-from models import Request
+from models import write_queue, NegativeResult, Request
 from templates import MessageTemplate, Translate
 
 
@@ -19,6 +32,46 @@ logging.getLogger(__name__).addHandler(logging.NullHandler())
 YKEY = config.Config.YKEY
 ENDPOINT = 'https://dictionary.yandex.net/api/v1/dicservice.json/lookup?'
 
+session = httpclient.DictionarySession(
+    connect_timeout=config.Config.HTTP_CONNECT_TIMEOUT,
+    read_timeout=config.Config.HTTP_READ_TIMEOUT,
+    retries=config.Config.HTTP_RETRIES,
+    backoff=config.Config.HTTP_BACKOFF,
+    pool_size=config.Config.HTTP_POOL_SIZE,
+    budget=httpclient.RetryBudget(ratio=config.Config.HTTP_RETRY_RATIO)
+)
+
+
+def record_transition(previous, state):
+    metrics.registry.counter('dictionary_breaker_{}'.format(state)).inc()
+
+
+circuit = breaker.CircuitBreaker(
+    failure_ratio=config.Config.BREAKER_FAILURE_RATIO,
+    slow_call=config.Config.BREAKER_SLOW_CALL,
+    window=config.Config.BREAKER_WINDOW,
+    min_calls=config.Config.BREAKER_MIN_CALLS,
+    reset_timeout=config.Config.BREAKER_RESET_TIMEOUT,
+    half_open_calls=config.Config.BREAKER_HALF_OPEN_CALLS,
+    failed=lambda response: response.status_code >= 500,
+    on_transition=record_transition
+)
+
+# concurrent lookups of the same word share a single upstream fetch
+flights = singleflight.SingleFlight()
+
+# bounds upstream fetches of batch requests across all handlers
+batch_pool = ThreadPoolExecutor(
+    config.Config.BATCH_CONCURRENCY, thread_name_prefix='batch_fetch')
+
+# stale answers are refreshed here, never on the thread replying
+refresh_pool = ThreadPoolExecutor(
+    config.Config.REFRESH_THREADS, thread_name_prefix='refresh')
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+TERM_SEPARATORS = re.compile(r'[\n,;]+')
+
 
 def answer_spellcheck(spellcheck, translate):
     if spellcheck:
@@ -30,18 +83,34 @@ def answer_spellcheck(spellcheck, translate):
     return translate
 
 
-def check_spelling(data):
+def check_spelling(data, fallback=True):
+    """
+    Returns (correction, spellcheck) for ``data``, spellcheck is None if
+    there is no correction. Words the local index can't correct are sent
+    to the speller service only with ``fallback`` on, and only once.
+    """
+    # the local index answers for every word it has seen
+    if data in spelling.index:
+        return data, None
+    correction = spelling.index.suggest(data)
+    if correction is not None:
+        return correction, spelling.Correction(data, correction)
+    fallback = fallback and config.Config.SPELLING_FALLBACK
+    if not fallback or cache.speller_misses.get(data):
+        return data, None
     try:
         spellcheck = pyaspeller.Word(data)
-        if spellcheck.spellsafe:
-            data = spellcheck.spellsafe
     except Exception as err:
         logging.exception(str(err))
-        spellcheck = None
-
+        return data, None
+    if spellcheck.spellsafe:
+        data = spellcheck.spellsafe
+    else:
+        cache.speller_misses.put(data, True)
     return data, spellcheck
 
 
+@metrics.timed('normalize')
 def normalize(data):
     warning = True
     if not data:
@@ -57,57 +126,225 @@ def normalize(data):
         return data.lower().strip(), warning
 
 
+def split_terms(text):
+    terms = []
+    for term in TERM_SEPARATORS.split(text):
+        content, warning = normalize(term)
+        if not warning and content and content not in terms:
+            terms.append(content)
+    return terms
+
+
+@metrics.timed('format_dict_message')
 def format_dict_message(data):
-    res = ''
-    delimeter = '\n'
-    nbsp = u'\xa0'
-    for _, topic in enumerate(data):
-        res += Translate.POS.format(topic['pos'])
+    # a single pass over the API dicts, joined once at the end
+    parts = []
+    append = parts.append
+    for topic in data:
+        append(Translate.POS.format(topic['pos']))
         if 'ts' in topic:
-            res += Translate.TRANSCRIPTION.format(topic['ts'], delimeter)
+            append(Translate.TRANSCRIPTION.format(topic['ts'], DELIMETER))
         else:
-            res += delimeter
+            append(DELIMETER)
         for tr in topic['tr']:
-            res += Translate.TRANSLATION.format(nbsps=4 * nbsp, text=tr['text'])
+            append(Translate.TRANSLATION.format(nbsps=INDENT, text=tr['text']))
             if 'mean' in tr:
-                mean = ''
-                for m in tr['mean']:
-                    mean += Translate.MEANING_UNIT.format(m=m['text'])
-                mean = Translate.MEANING.format(mean.rstrip('; '), delimeter)
-                res += mean
+                meaning = ''.join([Translate.MEANING_UNIT.format(m=m['text'])
+                                   for m in tr['mean']])
+                append(Translate.MEANING.format(meaning.rstrip('; '), DELIMETER))
             else:
-                res += delimeter
+                append(DELIMETER)
             if 'ex' in tr:
-                tmp = Translate.EXAMPLE.format(
-                    nbsps=8 * nbsp,
-                    ex=tr['ex'][0]['text'],
-                    ex_tr='/ '.join([etr['text'] for etr in tr['ex'][0]['tr']]),
-                    delimeter=delimeter
-                )
-                res += tmp
-    return res
+                example = tr['ex'][0]
+                append(Translate.EXAMPLE.format(
+                    nbsps=EXAMPLE_INDENT,
+                    ex=example['text'],
+                    ex_tr='/ '.join([etr['text'] for etr in example['tr']]),
+                    delimeter=DELIMETER
+                ))
+    return ''.join(parts)
 
 
-def dicservice_request(src):
+def dicservice_url(src):
     request = requests.compat.urlencode(
         {'key': YKEY, 'lang': 'en-ru', 'text': src})
-    return requests.get('{}{}'.format(ENDPOINT, request))
+    return '{}{}'.format(ENDPOINT, request)
 
 
-def load_content_from_db(request):
-    data = request.raw
-    json_dump = json.loads(data)
+@metrics.timed('dicservice_request')
+def dicservice_request(src):
+    return circuit.call(session.get, dicservice_url(src))
+
+
+def render_request(request):
+    json_dump = json.loads(request.load_raw())
     return format_dict_message(json_dump['def'])
 
 
+def load_content_from_db(request):
+    answer = cache.answers.get(request.content)
+    if answer is None:
+        if request.renderer == Translate.VERSION:
+            answer = request.answer
+        else:
+            # rendered by an outdated template, refresh the stored answer
+            answer = render_request(request)
+            request.answer = answer
+            request.renderer = Translate.VERSION
+            write_queue.submit(
+                request.save, only=[Request.answer, Request.renderer])
+        # a stale row may have been refreshed since it was read, the
+        # refresh caches the new answer itself
+        if not is_stale(request):
+            cache.answers.put(request.content, answer)
+    revalidate(request)
+    return answer
+
+
+def is_stale(request):
+    stale_after = config.Config.STALE_AFTER
+    return bool(stale_after) and request.fetched + stale_after <= time.time()
+
+
+def revalidate(request):
+    """
+    Schedules a background refresh of a stale ``request``, the stored
+    answer is served meanwhile. Returns True if a refresh was scheduled.
+    """
+    if not is_stale(request) or circuit.state == breaker.OPEN:
+        return False
+    with _refreshing_lock:
+        if request.content in _refreshing:
+            return False
+        _refreshing.add(request.content)
+    refresh_pool.submit(_refresh, request.content)
+    return True
+
+
+def _refresh(content):
+    try:
+        raw = fetch_content(content)
+        defenition = json.loads(raw)['def']
+        # an entry gone from the dictionary keeps its last answer
+        if defenition:
+            write_queue.submit(
+                Request.refresh,
+                content,
+                raw=raw,
+                answer=format_dict_message(defenition),
+                renderer=Translate.VERSION
+            ).result()
+    except exceptions.CircuitOpen:
+        logging.info('refresh of %s skipped, dictionary unavailable', content)
+    except Exception as err:
+        logging.exception(str(err))
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(content)
+
+
+def is_known_miss(content):
+    if cache.misses.get(content):
+        return True
+    if config.Config.NEGATIVE_CACHE_PERSIST:
+        expires = NegativeResult.get_expiry(content)
+        if expires:
+            cache.misses.put(content, True, ttl=expires - time.time())
+            return True
+    return False
+
+
+def remember_miss(content):
+    cache.misses.put(content, True)
+    if config.Config.NEGATIVE_CACHE_PERSIST:
+        write_queue.submit(
+            NegativeResult.remember, content, config.Config.NEGATIVE_CACHE_TTL)
+
+
 def load_content_from_api(content):
-    data = dicservice_request(content)
-    json_dump = data.json()
+    return flights.do(content, _load_content_from_api, content)
+
+
+def fetch_content(content):
+    # the local dictionary index, if there is one, saves a network call
+    raw = offline.lookup(content)
+    if raw is None:
+        raw = dicservice_request(content).text
+    return raw
+
+
+def shared_fetch(content):
+    # a batch and a single lookup of the same word share the request
+    return flights.do(('fetch', content), fetch_content, content)
+
+
+def _load_content_from_api(content):
+    return store_content(content, shared_fetch(content))
+
+
+def store_content(content, raw):
+    json_dump = json.loads(raw)
     defenition = json_dump['def']
     if not defenition:
+        remember_miss(content)
         return '', None
-    request = Request.create(content=content, raw=data.text)
-    return format_dict_message(defenition), request
+    answer = format_dict_message(defenition)
+    request, created = write_queue.submit(
+        Request.insert_or_get,
+        content=content,
+        raw=raw,
+        answer=answer,
+        renderer=Translate.VERSION,
+        fetched=int(time.time())
+    ).result()
+    if created:
+        spelling.index.add(request.content)
+    cache.answers.put(request.content, answer)
+    return answer, request
+
+
+def _fetch_or_none(content):
+    try:
+        return shared_fetch(content)
+    except exceptions.CircuitOpen:
+        return None
+    except Exception as err:
+        logging.exception(str(err))
+
+
+def fetch_many(contents):
+    return list(batch_pool.map(_fetch_or_none, contents))
+
+
+def lookup_many(contents, fetch=fetch_many):
+    """
+    Resolves every content through the cache, the database and the API.
+    Contents missing everywhere are fetched in parallel with ``fetch``.
+    Returns (answer, request) pairs in the order of ``contents``, answer
+    is empty for misses and failed fetches.
+    """
+    results = {}
+    pending = []
+    for content in contents:
+        request = Request.get_request(content=content)
+        if request:
+            results[content] = load_content_from_db(request), request
+        elif is_known_miss(content):
+            results[content] = '', None
+        else:
+            pending.append(content)
+    for content, raw in zip(pending, fetch(pending) if pending else []):
+        if raw is None:
+            results[content] = '', None
+        else:
+            results[content] = store_content(content, raw)
+    return [results[content] for content in contents]
+
+
+DELIMETER = '\n'
+NBSP = u'\xa0'
+INDENT = 4 * NBSP
+EXAMPLE_INDENT = 8 * NBSP
 
 
 class Word(object):
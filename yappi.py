@@ -3,6 +3,7 @@ A main module with Yappi translator bot powered by Telegram Bot API.
 """
 
 import logging
+import secrets
 import urllib
 
 from functools import partial, wraps
@@ -10,12 +11,25 @@ from inspect import signature
 
 from telegram import InlineKeyboardButton as Button
 from telegram import Emoji, InlineKeyboardMarkup, ParseMode
+from telegram.constants import MAX_MESSAGE_LENGTH
 from telegram.ext import Updater, CommandHandler, MessageHandler, CallbackQueryHandler, Filters
 
+import aio
+import cache
+import callbacks
+import metrics
+import outbox
+import spelling
+import warmup
+import webhook
+import workers
 import yadict
 import config
+import exceptions
 
-from models import db, CallbackEntity, Request, User, Chat, FirstRequest, Message
+from models import (db, popularity, save_first_request, seen_first_requests,
+                    seen_requests, start_seen, write_queue,
+                    User, Chat, FirstRequest, Message, Statistic)
 from templates import MessageTemplate, Translate
 
 
@@ -33,6 +47,28 @@ def logging_setup():
         )
 
 FORWARD_URL = 'https://telegram.me/{fwd_bot}?start={fwd_url}'
+DELIMETER = '\n'
+
+
+def worker_queue_size():
+    """
+    Updates waiting per handler worker, unbounded for 0. In webhook mode
+    the queues are always bounded: the webhook only answers 503 once
+    the dispatcher is held up by full worker queues.
+    """
+    size = config.Config.WORKER_QUEUE_SIZE
+    if size or config.Config.UPDATE_MODE != 'webhook':
+        return size
+    # the webhook queue, shared among the workers
+    return max(1, config.Config.WEBHOOK_QUEUE_SIZE //
+               max(config.Config.WORKERS, 1))
+
+
+handler_pool = workers.ShardedExecutor(
+    workers=max(config.Config.WORKERS, 1),
+    max_queue=worker_queue_size()
+)
+on_pool = workers.sharded(handler_pool)
 
 
 class AnswerOption(object):
@@ -41,7 +77,7 @@ class AnswerOption(object):
 
 
 def save_callback_data(data):
-    return CallbackEntity.create(data=data)
+    return callbacks.store.save(data)
 
 
 def encode_callback_data(answer_option, index):
@@ -50,56 +86,38 @@ def encode_callback_data(answer_option, index):
 
 def decode_callback_data(callback_data):
     index = int(callback_data.split('@')[1])
-    return CallbackEntity.get_callback(index)
+    return callbacks.store.pop(index)
 
 
 def decode_answer_option(callback_data):
     return callback_data.split('@')[0]
 
 
-def userify(func):
+def contextify(func):
+    """
+    Resolves user, chat and message of the update in a single transaction
+    and passes them to the handler as keyword arguments.
+    """
     @wraps(func)
-    @db.atomic()
     def wrapper(*args, **kwargs):
         update = args[1]
         request = update.callback_query or update.message
-        tid = request.from_user.id
-        name = request.from_user.first_name
-        user, _ = User.get_or_create(tid=tid, name=name)
-        kwargs['user'] = user
-        return func(*args, **kwargs)
-    return wrapper
-
-
-def chatify(func):
-    @wraps(func)
-    @db.atomic()
-    def wrapper(*args, **kwargs):
-        update = args[1]
-        request = update.callback_query or update
-        chat_id = request.message.chat_id
-        chat, _ = Chat.get_or_create(chat_id=chat_id)
-        kwargs['chat'] = chat
-        return func(*args, **kwargs)
-    return wrapper
-
-
-def messagify(func):
-    @wraps(func)
-    @db.atomic()
-    def wrapper(*args, **kwargs):
-        update = args[1]
-        request = update.callback_query or update
-        message_id = request.message.message_id
-        time = request.message.to_dict()['date']
-        message = Message.create(
-            chat=kwargs['chat'],
-            user=kwargs['user'],
-            message_id=message_id,
-            time=time
-        )
-        kwargs['message'] = message
-        return func(*args, **kwargs)
+        tg_message = (update.callback_query or update).message
+        # a context per call, the decorator form shares one between threads
+        with db.atomic():
+            user = User.resolve(
+                tid=request.from_user.id, name=request.from_user.first_name)
+            chat = Chat.resolve(chat_id=tg_message.chat_id)
+            kwargs['user'] = user
+            kwargs['chat'] = chat
+            kwargs['message'] = write_queue.submit(
+                Message.create,
+                chat=chat,
+                user=user,
+                message_id=tg_message.message_id,
+                time=tg_message.to_dict()['date']
+            ).result()
+            return func(*args, **kwargs)
     return wrapper
 
 
@@ -127,40 +145,81 @@ def forward(func):
     return wrapper
 
 
+@metrics.timed('edit_message')
 @forward
 def edit_message(bot, update, text, success=None, request=None, **kwargs):
-    return bot.edit_message_text(
-        chat_id=update.callback_query.message.chat_id,
+    return outbox.scheduler.edit(
+        bot,
+        update.callback_query.message.chat_id,
+        update.callback_query.message.message_id,
         text=text,
-        message_id=update.callback_query.message.message_id,
         reply_markup=kwargs['markup'],
         parse_mode=ParseMode.MARKDOWN
     )
 
 
+@metrics.timed('send_message')
 @forward
 def send_message(bot, update, text, success=None, request=None, **kwargs):
-    return bot.send_message(
-        chat_id=update.message.chat_id,
-        text=text,
+    return outbox.scheduler.send(
+        bot,
+        update.message.chat_id,
+        text,
         reply_markup=kwargs['markup'],
         parse_mode=ParseMode.MARKDOWN
     )
 
 
-@db.atomic()
+def save_when_sent(sent, **kwargs):
+    """
+    Saves the first request answered by the ``sent`` message future once
+    the outbox has delivered it. With the write queue running, handlers
+    don't wait for the outbox inside their transactions.
+    """
+    def save(future):
+        # a failed delivery is logged by the outbox
+        if future.exception() is None:
+            write_queue.submit(
+                save_first_request,
+                reply_to=future.result().message_id,
+                **kwargs
+            )
+    if write_queue.running:
+        sent.add_done_callback(save)
+    else:
+        # an inline write on the outbox thread would wait for the write
+        # lock held by the next handler and stall every outgoing message
+        save(sent)
+
+
+def corrected_reply(reply, spellcheck):
+    def wrapper(text, **kwargs):
+        return reply(yadict.answer_spellcheck(spellcheck, text), **kwargs)
+    return wrapper
+
+
 def translate(content, user, chat, message, bot, reply):
+    with db.atomic():
+        _translate(content, user, chat, message, bot, reply)
+
+
+def load_content_from_api(content):
+    # blocks this handler thread, the fetch shares the loop with batches
+    if aio.pipeline.running:
+        return aio.pipeline.run(aio.pipeline.load_content_from_api(content))
+    return yadict.load_content_from_api(content)
+
+
+# the retry of a corrected request recurses here, in the same transaction
+def _translate(content, user, chat, message, bot, reply, correct=True):
     def reply_and_save(request):
         response = Translate.HEAD.format(caption=content, answer=answer)
-        reply_message = reply(response, success=True, request=content)
-        message.request = request
-        message.save()
-        FirstRequest.create(
+        save_when_sent(
+            reply(response, success=True, request=content),
             request=request,
             chat=chat,
             user=user,
-            message=message,
-            reply_to=reply_message.message_id
+            message=message
         )
     content, warning = yadict.normalize(content)
     if warning:
@@ -170,38 +229,143 @@ def translate(content, user, chat, message, bot, reply):
         chat=chat, user=user, content=content)
     if fr_query:
         reply(MessageTemplate.ALREADY_REQUESTED, success=True, request=content)
-        bot.send_message(
+        outbox.scheduler.send(
+            bot,
             chat.chat_id,
             Emoji.WHITE_UP_POINTING_INDEX,
             reply_to_message_id=fr_query.reply_to
         )
+        return
+    known_miss = False
+    if request:
+        answer = yadict.load_content_from_db(request)
+    elif yadict.is_known_miss(content):
+        answer, known_miss = None, True
     else:
-        if request:
-            answer = yadict.load_content_from_db(request)
-            reply_and_save(request)
-        else:
-            answer, created_request = yadict.load_content_from_api(content)
-            if not answer:
-                reply(MessageTemplate.CANT_FIND.format(content))
+        try:
+            answer, request = load_content_from_api(content)
+        except exceptions.CircuitOpen:
+            reply(MessageTemplate.DICTIONARY_UNAVAILABLE)
+            return
+    if answer:
+        reply_and_save(request)
+        return
+    # a typo misses both the db and the dictionary, retry the correction
+    if correct:
+        # a known miss was offered to the speller service already
+        correction, spellcheck = yadict.check_spelling(
+            content, fallback=not known_miss)
+        if spellcheck is not None and correction != content:
+            _translate(correction, user, chat, message, bot,
+                       corrected_reply(reply, spellcheck), correct=False)
+            return
+    reply(MessageTemplate.CANT_FIND.format(content))
+
+
+def cut_lines(text, limit):
+    """
+    Cuts ``text`` into chunks of at most ``limit`` characters at line
+    breaks, so markdown entities stay whole. Only a single line longer
+    than ``limit`` is cut inside, blank chunks are dropped.
+    """
+    chunks, lines, size = [], [], 0
+    for line in text.split(DELIMETER):
+        while len(line) > limit:
+            if lines:
+                chunks.append(DELIMETER.join(lines))
+                lines, size = [], 0
+            chunks.append(line[:limit])
+            line = line[limit:]
+        added = len(line) + (len(DELIMETER) if lines else 0)
+        if lines and size + added > limit:
+            chunks.append(DELIMETER.join(lines))
+            lines, size, added = [], 0, len(line)
+        lines.append(line)
+        size += added
+    if lines:
+        chunks.append(DELIMETER.join(lines))
+    # Telegram rejects empty texts, as after the final line break
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def split_message(parts, limit=MAX_MESSAGE_LENGTH):
+    """
+    Packs ``parts`` into as few messages as fit in ``limit``. A part is only
+    cut when it doesn't fit in a message on its own. Returns a list of
+    (text, indexes of the parts in it) pairs.
+    """
+    messages = []
+    text, indexes = '', []
+    for index, part in enumerate(parts):
+        if text and len(text) + len(DELIMETER) + len(part) > limit:
+            messages.append((text, indexes))
+            text, indexes = '', []
+        if len(part) > limit:
+            for number, chunk in enumerate(cut_lines(part, limit)):
+                messages.append((chunk, [index] if not number else []))
+            continue
+        text = text + DELIMETER + part if text else part
+        indexes.append(index)
+    if text:
+        messages.append((text, indexes))
+    return messages
+
+
+def fetch_many(contents):
+    if aio.pipeline.running:
+        return aio.pipeline.run(aio.pipeline.fetch_many(contents))
+    return yadict.fetch_many(contents)
+
+
+def translate_batch(contents, user, chat, message, reply):
+    with db.atomic():
+        found = []
+        missing = []
+        results = yadict.lookup_many(contents, fetch=fetch_many)
+        for content, (answer, request) in zip(contents, results):
+            if answer:
+                found.append((content, answer, request))
             else:
-                reply_and_save(created_request)
-
-
-@chatify
-@userify
-@messagify
+                missing.append(content)
+
+        parts = [Translate.HEAD.format(caption=content, answer=answer)
+                 for content, answer, _ in found]
+        if missing:
+            parts.append(
+                MessageTemplate.CANT_FIND.format('`, `'.join(missing)))
+        for text, indexes in split_message(parts):
+            sent = reply(text)
+            for index in indexes:
+                if index == len(found):
+                    continue
+                _, _, request = found[index]
+                if FirstRequest.get_first_request(request, chat, user):
+                    continue
+                save_when_sent(
+                    sent, request=request, chat=chat, user=user, message=message)
+
+
+def command_text(update):
+    parts = update.message.text.split(None, 1)
+    return parts[1] if len(parts) > 1 else ''
+
+
+@contextify
 def translate_command(bot, update, args, **kwargs):
     user = kwargs['user']
     chat = kwargs['chat']
     message = kwargs['message']
 
     reply = partial(send_message, bot, update)
-    translate(args, user, chat, message, bot, reply)
+    contents = yadict.split_terms(command_text(update))
+    if len(contents) > 1:
+        contents = contents[:config.Config.BATCH_MAX_TERMS]
+        translate_batch(contents, user, chat, message, reply)
+    else:
+        translate(args, user, chat, message, bot, reply)
 
 
-@chatify
-@userify
-@messagify
+@contextify
 def handle_text(bot, update, user_data, **kwargs):
     user_data['user'] = kwargs['user']
     user_data['chat'] = kwargs['chat']
@@ -218,9 +382,10 @@ def handle_text(bot, update, user_data, **kwargs):
     ]]
     markup = InlineKeyboardMarkup(keyboard)
 
-    bot.send_message(
-        chat_id=update.message.chat_id,
-        text=MessageTemplate.TRANSLATE,
+    outbox.scheduler.send(
+        bot,
+        update.message.chat_id,
+        MessageTemplate.TRANSLATE,
         reply_markup=markup,
         parse_mode=ParseMode.MARKDOWN)
 
@@ -268,34 +433,119 @@ def stats(bot, update):
         MessageTemplate.USER_STATS_LINE.format(el[0], el[1])
         for el in FirstRequest.statistics()
     )
-    stats_message += MessageTemplate.TOTAL_ENTITIES.format(len(Request.select()))
-
-    bot.sendMessage(
+    stats_message += MessageTemplate.TOTAL_ENTITIES.format(
+        Statistic.get_value(Statistic.REQUESTS))
+    stats_message += MessageTemplate.HIT_RATE_LINE.format(
+        'Answer cache', cache.answers.hit_rate)
+    stats_message += MessageTemplate.HIT_RATE_LINE.format(
+        'Negative cache', cache.misses.hit_rate)
+
+    outbox.scheduler.send(
+        bot,
         update.message.chat_id,
         stats_message,
         parse_mode=ParseMode.MARKDOWN
     )
 
 
+def latency(bot, update):
+    if update.message.from_user.id not in config.Config.ADMINS:
+        return
+    if not metrics.registry.enabled:
+        latency_message = MessageTemplate.METRICS_DISABLED
+    else:
+        latency_message = 'Latency:\n'
+        latency_message += ''.join(
+            MessageTemplate.LATENCY_LINE.format(
+                name, p50 * 1000, p99 * 1000, count)
+            for name, count, (p50, p99) in metrics.registry.summary()
+        )
+
+    outbox.scheduler.send(
+        bot,
+        update.message.chat_id,
+        latency_message,
+        parse_mode=ParseMode.MARKDOWN
+    )
+
+
+def register_collectors():
+    metrics.registry.collector('answer_cache', cache.answers.stats)
+    metrics.registry.collector('negative_cache', cache.misses.stats)
+    metrics.registry.collector('speller_misses', cache.speller_misses.stats)
+    metrics.registry.collector('dictionary', yadict.session.stats)
+    metrics.registry.collector('dictionary_breaker', yadict.circuit.stats)
+    metrics.registry.collector('write_queue', write_queue.stats)
+    metrics.registry.collector('handler_pool', handler_pool.stats)
+    metrics.registry.collector('outbox', outbox.scheduler.stats)
+    metrics.registry.collector('seen_requests', seen_requests.stats)
+    metrics.registry.collector(
+        'seen_first_requests', seen_first_requests.stats)
+
+
 def main():
     logging_setup()
-    updater = Updater(config.Config.BTOKEN)
+    # a random path is only of use when the bot registers it itself
+    if (config.Config.UPDATE_MODE == 'webhook' and
+            not config.Config.WEBHOOK_URL and not config.Config.WEBHOOK_SECRET):
+        raise SystemExit('webhook_secret is required when webhook_url is empty')
+    register_collectors()
+    metrics.start()
+    # pipeline threads must not wait on the write lock held by handlers
+    # and neither must the handlers running in parallel on the workers,
+    # replies sent by the outbox save their first requests through it
+    if (config.Config.WRITE_QUEUE or config.Config.WORKERS or
+            config.Config.OUTBOX or config.Config.ASYNC_LOOKUPS):
+        write_queue.start()
+    if config.Config.ASYNC_LOOKUPS:
+        aio.pipeline.start()
+    popularity.start()
+    callbacks.store.start()
+    if config.Config.WARMUP_SIZE:
+        warmup.start(config.Config.WARMUP_SIZE)
+    spelling.start()
+    start_seen()
+    if config.Config.OUTBOX:
+        outbox.scheduler.start()
+    if config.Config.WORKERS:
+        handler_pool.start()
+    # the bot's connection pool is sized by the number of workers
+    updater = Updater(config.Config.BTOKEN, workers=max(config.Config.WORKERS, 4))
 
     updater.dispatcher.add_handler(
         CallbackQueryHandler(
-            callback_handler,
+            on_pool(callback_handler),
             pass_user_data=True,
             pass_chat_data=True
         )
     )
     updater.dispatcher.add_handler(
-        CommandHandler('tr', translate_command, pass_args=True))
-    updater.dispatcher.add_handler(CommandHandler('stats', stats))
+        CommandHandler('tr', on_pool(translate_command), pass_args=True))
+    updater.dispatcher.add_handler(CommandHandler('stats', on_pool(stats)))
     updater.dispatcher.add_handler(
-        MessageHandler(Filters.text, handle_text, pass_user_data=True))
-
-    updater.start_polling()
+        CommandHandler('latency', on_pool(latency)))
+    updater.dispatcher.add_handler(
+        MessageHandler(Filters.text, on_pool(handle_text), pass_user_data=True))
+
+    if config.Config.UPDATE_MODE == 'webhook':
+        secret = config.Config.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+        server = webhook.start(
+            updater,
+            path='/' + secret,
+            port=config.Config.WEBHOOK_PORT,
+            host=config.Config.WEBHOOK_LISTEN,
+            url=config.Config.WEBHOOK_URL,
+            queue_size=config.Config.WEBHOOK_QUEUE_SIZE
+        )
+        metrics.registry.collector('webhook', server.stats)
+    else:
+        updater.start_polling()
     updater.idle()
+    handler_pool.stop()
+    outbox.scheduler.stop()
+    aio.pipeline.stop()
+    popularity.stop()
+    write_queue.stop()
 
 if __name__ == '__main__':
     main()